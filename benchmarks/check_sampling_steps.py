@@ -0,0 +1,87 @@
+"""
+Replays denoiser sigmas recorded from k-diffusion samplers and checks the step each call is attributed to.
+Exits with a non zero status when a call lands on the wrong step:
+
+    python benchmarks/check_sampling_steps.py
+"""
+import dataclasses
+import sys
+from typing import List
+import webui_stubs
+webui_stubs.install()
+
+from lib_free_u import sampling_steps
+
+
+@dataclasses.dataclass
+class Recording:
+    name: str
+    sampler_function_name: str
+    # schedule returned by get_sigmas
+    sigmas: List[float]
+    # sigma of each denoiser call, in call order
+    denoiser_sigmas: List[float]
+    expected_steps: List[int]
+
+
+# recorded with k-diffusion 0.0.16, a model that logs its sigma, and the karras schedule of SD 1.5 (sigma_min 0.0292, sigma_max 14.6146)
+RECORDINGS = [
+    Recording(
+        name="euler",
+        # txt2img, 6 karras steps
+        sampler_function_name="sample_euler",
+        sigmas=[14.614602088928223, 6.082771301269531, 2.2326910495758057, 0.6928669214248657, 0.1698753535747528, 0.02920001931488514, 0.0],
+        denoiser_sigmas=[14.614602088928223, 6.082771301269531, 2.2326910495758057, 0.6928669214248657, 0.1698753535747528, 0.02920001931488514],
+        expected_steps=[0, 1, 2, 3, 4, 5],
+    ),
+    Recording(
+        name="heun",
+        # txt2img, 6 karras steps
+        sampler_function_name="sample_heun",
+        sigmas=[14.614602088928223, 6.082771301269531, 2.2326910495758057, 0.6928669214248657, 0.1698753535747528, 0.02920001931488514, 0.0],
+        denoiser_sigmas=[14.614602088928223, 6.082771301269531, 6.082771301269531, 2.2326910495758057, 2.2326910495758057, 0.6928669214248657, 0.6928669214248657, 0.1698753535747528, 0.1698753535747528, 0.02920001931488514, 0.02920001931488514],
+        expected_steps=[0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5],
+    ),
+    Recording(
+        name="dpm2",
+        # txt2img, 6 karras steps, next to last sigma discarded like webui does for dpm2
+        sampler_function_name="sample_dpm_2",
+        sigmas=[14.614602088928223, 7.095001697540283, 3.169205904006958, 1.2745158672332764, 0.4471449851989746, 0.13040627539157867, 0.0],
+        denoiser_sigmas=[14.614602088928223, 10.182859420776367, 7.095001697540283, 4.741889953613281, 3.169205904006958, 2.0097768306732178, 1.2745158672332764, 0.754912793636322, 0.4471449851989746, 0.24147570133209229, 0.13040627539157867],
+        expected_steps=[0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5],
+    ),
+    Recording(
+        name="img2img euler",
+        # img2img, 8 karras steps at denoising strength 0.5, the sampler starts at sigmas[3]
+        sampler_function_name="sample_euler",
+        sigmas=[14.614602088928223, 7.903483867645264, 4.028369426727295, 1.910859227180481, 0.8291969895362854, 0.32130250334739685, 0.10728425532579422, 0.02920001931488514, 0.0],
+        denoiser_sigmas=[1.910859227180481, 0.8291969895362854, 0.32130250334739685, 0.10728425532579422, 0.02920001931488514],
+        expected_steps=[0, 1, 2, 3, 4],
+    ),
+    Recording(
+        name="img2img heun",
+        # img2img, 8 karras steps at denoising strength 0.5, the sampler starts at sigmas[3]
+        sampler_function_name="sample_heun",
+        sigmas=[14.614602088928223, 7.903483867645264, 4.028369426727295, 1.910859227180481, 0.8291969895362854, 0.32130250334739685, 0.10728425532579422, 0.02920001931488514, 0.0],
+        denoiser_sigmas=[1.910859227180481, 0.8291969895362854, 0.8291969895362854, 0.32130250334739685, 0.32130250334739685, 0.10728425532579422, 0.10728425532579422, 0.02920001931488514, 0.02920001931488514],
+        expected_steps=[0, 0, 1, 1, 2, 2, 3, 3, 4],
+    ),
+]
+
+
+def main():
+    failures = 0
+    for recording in RECORDINGS:
+        corrector_at_next_sigma = recording.sampler_function_name in sampling_steps.CORRECTOR_SAMPLERS
+        steps = sampling_steps.replay(recording.sigmas, recording.denoiser_sigmas, corrector_at_next_sigma)
+        failed = steps != recording.expected_steps
+        failures += failed
+        print(f"{recording.name:<16}{str(steps):<40}{'FAILED, expected ' + str(recording.expected_steps) if failed else 'ok'}")
+
+    print(f"{failures} failure(s)")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
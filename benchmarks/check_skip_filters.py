@@ -0,0 +1,116 @@
+"""
+Checks the skip filter engines against filter_skip_fft, the reference implementation of the paper.
+Exits with a non zero status when an engine is out of tolerance. Runs on CPU by default:
+
+    python benchmarks/check_skip_filters.py
+    python benchmarks/check_skip_filters.py --device cuda
+"""
+import argparse
+import itertools
+import sys
+import webui_stubs
+webui_stubs.install()
+
+import torch
+from modules import shared
+from lib_free_u import unet
+
+
+RFFT_SHAPES = [
+    (2, 8, 16, 16),
+    (2, 8, 15, 15),
+    (2, 8, 16, 15),
+    (2, 8, 15, 16),
+    (2, 8, 17, 24),
+    (3, 8, 1, 7),
+]
+RFFT_THRESHOLDS = [0.0, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0]
+# per sample params of a batch, the batch size is not always a multiple of the configs count
+RFFT_STACKED_PARAMS = [
+    ((0.1, 0.5), (0.9, 1.2), (1.0, 1.1)),
+    ((0.0, 1.0, 0.25), (1.1, 0.8, 1.0), (1.2, 1.0, 0.9)),
+]
+RFFT_TOLERANCE = 1e-5
+
+REDUCED_PRECISION_SHAPES = [
+    (2, 64, 16, 16),
+    (2, 64, 32, 32),
+    (2, 32, 64, 64),
+    (2, 32, 128, 128),
+    (2, 32, 96, 72),
+]
+REDUCED_PRECISION_ENGINES = ["rfft", "matmul", "lowrank"]
+REDUCED_PRECISION_THRESHOLDS = [0.05, 0.1, 0.5, 1.0]
+REDUCED_PRECISION_SCALES_HIGH = [1.0, 1.1]
+
+# relative to the largest output value: 2 units of the dtype precision, 2e-3 for float16 and 1.6e-2 for bfloat16
+# the inputs are rounded to the dtype before computing the reference, so only the computation of the engine is measured
+REDUCED_PRECISION_TOLERANCES = {
+    torch.float16: 2 * torch.finfo(torch.float16).eps,
+    torch.bfloat16: 2 * torch.finfo(torch.bfloat16).eps,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    failures = check_rfft(device)
+    failures += check_reduced_precision(device)
+
+    print(f"{failures} failure(s)")
+    if failures:
+        sys.exit(1)
+
+
+def check_rfft(device: torch.device) -> int:
+    failures = 0
+    print(f"{'shape':<24}{'params':<48}{'max rel err':>14}")
+    for shape in RFFT_SHAPES:
+        x = torch.randn(shape, device=device)
+        params_list = [
+            *((threshold, 0.9, scale_high) for threshold, scale_high in itertools.product(RFFT_THRESHOLDS, [1.0, 1.1])),
+            *RFFT_STACKED_PARAMS,
+        ]
+        for params in params_list:
+            error = get_relative_error(unet.filter_skip_rfft(x, *params), unet.filter_skip_fft(x, *params))
+            failed = error > RFFT_TOLERANCE
+            failures += failed
+            print(f"{str(shape):<24}{str(params):<48}{error:>14.2e}{'  FAILED' if failed else ''}")
+
+    print()
+    return failures
+
+
+def check_reduced_precision(device: torch.device) -> int:
+    shared.opts.data["freeu_skip_filter_precision"] = "reduced"
+    failures = 0
+    try:
+        print(f"{'dtype':<16}{'shape':<24}{'engine':<10}{'max rel err':>14}{'tolerance':>12}")
+        for dtype, shape in itertools.product(REDUCED_PRECISION_TOLERANCES, REDUCED_PRECISION_SHAPES):
+            x = torch.randn(shape, device=device).to(dtype)
+            tolerance = REDUCED_PRECISION_TOLERANCES[dtype]
+            for engine_name in REDUCED_PRECISION_ENGINES:
+                engine = unet.skip_filter_engines[engine_name]
+                error = max(
+                    get_relative_error(engine(x, threshold, 0.9, scale_high), unet.filter_skip_fft(x.float(), threshold, 0.9, scale_high))
+                    for threshold, scale_high in itertools.product(REDUCED_PRECISION_THRESHOLDS, REDUCED_PRECISION_SCALES_HIGH)
+                )
+                failed = error > tolerance
+                failures += failed
+                print(f"{str(dtype):<16}{str(shape):<24}{engine_name:<10}{error:>14.2e}{tolerance:>12.1e}{'  FAILED' if failed else ''}")
+    finally:
+        shared.opts.data.pop("freeu_skip_filter_precision", None)
+
+    return failures
+
+
+def get_relative_error(result: torch.Tensor, reference: torch.Tensor) -> float:
+    return ((result.float() - reference).abs().max() / reference.abs().max()).item()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Times the FreeU hot path on CPU tensors shaped like the decoder concats of real models, and prints the results as JSON.
+Save the output of two commits and compare them to catch regressions:
+
+    python benchmarks/hot_path.py --output before.json
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import webui_stubs
+webui_stubs.install()
+
+import torch
+from modules import shared
+from lib_free_u import global_state, unet
+
+
+# (backbone channels, skip channels, latent downscale) of each decoder concat, in forward order
+SD_UNET_CONCATS = [
+    (1280, 1280, 8), (1280, 1280, 8), (1280, 1280, 8),
+    (1280, 1280, 4), (1280, 1280, 4), (1280, 640, 4),
+    (1280, 640, 2), (640, 640, 2), (640, 320, 2),
+    (640, 320, 1), (320, 320, 1), (320, 320, 1),
+]
+SDXL_UNET_CONCATS = [
+    (1280, 1280, 4), (1280, 1280, 4), (1280, 640, 4),
+    (1280, 640, 2), (640, 640, 2), (640, 320, 2),
+    (640, 320, 1), (320, 320, 1), (320, 320, 1),
+]
+MODELS = {
+    "sd15": (SD_UNET_CONCATS, [512, 768], "SD1.4 Recommendations"),
+    "sd21": (SD_UNET_CONCATS, [768], "SD2.1 Recommendations"),
+    "sdxl": (SDXL_UNET_CONCATS, [1024], "SDXL Recommendations"),
+}
+VERSIONS = ["1", "2"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", choices=list(MODELS.keys()), default=list(MODELS.keys()))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[2, 4], help="unet batch sizes, cond and uncond included")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--engine", default=None, help="skip filter engine, defaults to the extension default")
+    parser.add_argument("--output", default=None, help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    if args.engine is not None:
+        shared.opts.data["freeu_skip_filter_engine"] = args.engine
+
+    results = [benchmark_ratio_to_region(args.repeat)]
+    for model_name in args.models:
+        concats, resolutions, preset_name = MODELS[model_name]
+        for resolution in resolutions:
+            for batch_size in args.batch_sizes:
+                results.extend(benchmark_model(model_name, concats, resolution, batch_size, preset_name, args.repeat))
+
+    report = json.dumps({"meta": get_meta(args), "results": results}, indent=4)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, "w") as f:
+            f.write(report)
+
+
+def benchmark_model(model_name, concats, resolution, batch_size, preset_name, repeat):
+    latent_size = resolution // 8
+    tensors = [
+        (
+            torch.randn(batch_size, h_channels, latent_size // downscale, latent_size // downscale),
+            torch.randn(batch_size, skip_channels, latent_size // downscale, latent_size // downscale),
+        )
+        for h_channels, skip_channels, downscale in concats
+    ]
+    block_inputs = [torch.cat([h, h_skip], dim=1) for h, h_skip in tensors]
+    context = {"model": model_name, "resolution": resolution, "batch_size": batch_size}
+    results = []
+
+    for version in VERSIONS:
+        state = global_state.default_presets[preset_name].copy()
+        state.version = version
+        generation_state = global_state.get_generation_state()
+        generation_state.plan = unet.Plan(state, shared.state.sampling_steps)
+        generation_state.current_sampling_step = 0
+
+        def unet_decoder_blocks():
+            for (h, _), x in zip(tensors, block_inputs):
+                unet.free_u_output_block_hook(None, (x,), backbone_channels=h.shape[1])
+
+        results.append(measure("free_u_output_block_hook", unet_decoder_blocks, repeat, version=version, **context))
+
+        for h_channels in sorted({h.shape[1] for h, _ in tensors}, reverse=True):
+            h = next(h for h, _ in tensors if h.shape[1] == h_channels)
+            stage_info = state.stage_infos[unet.default_stage_layout.stage_channels.index(h_channels)]
+            results.append(measure(
+                "get_backbone_scale",
+                lambda: unet.get_backbone_scale(h, stage_info.backbone_factor, version),
+                repeat, version=version, shape=list(h.shape), **context,
+            ))
+
+        generation_state.plan = None
+
+    for _, h_skip in tensors:
+        if any(result.get("shape") == list(h_skip.shape) for result in results if result["benchmark"] == "filter_skip"):
+            continue
+
+        results.append(measure(
+            "filter_skip",
+            lambda: unet.filter_skip(h_skip, threshold=0.1, scale=0.9, scale_high=1.1),
+            repeat, shape=list(h_skip.shape), **context,
+        ))
+
+    return results
+
+
+def benchmark_ratio_to_region(repeat):
+    def ratio_to_region():
+        for _ in range(1000):
+            unet.ratio_to_region(0.75, 0.5, 1280)
+
+    result = measure("ratio_to_region", ratio_to_region, repeat)
+    result["calls_per_run"] = 1000
+    return result
+
+
+def measure(name, function, repeat, **context):
+    function()  # warm up caches
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return {
+        "benchmark": name,
+        **context,
+        "mean_ms": statistics.mean(timings),
+        "min_ms": min(timings),
+        "repeat": repeat,
+    }
+
+
+def get_meta(args):
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=webui_stubs.REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "torch": torch.__version__,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "threads": torch.get_num_threads(),
+        "engine": shared.opts.data.get("freeu_skip_filter_engine", "rfft"),
+        "sampling_steps": shared.state.sampling_steps,
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Compares the skip filter engines that can stand in for the complex FFT on devices without complex support.
+Everything runs on CPU, so no special hardware is needed:
+
+    python benchmarks/skip_filter_fallbacks.py
+"""
+import argparse
+import timeit
+import webui_stubs
+webui_stubs.install()
+
+import torch
+from lib_free_u import unet
+
+
+SHAPES = [
+    (2, 1280, 16, 16),
+    (2, 1280, 32, 32),
+    (2, 640, 64, 64),
+    (2, 320, 128, 128),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print(f"{'shape':<24}{'engine':<10}{'ms':>10}{'max abs err':>14}")
+    for shape in SHAPES:
+        x = torch.randn(shape)
+        reference = unet.filter_skip_fft(x, args.threshold, 0.9, 1.1)
+        for name, engine in unet.skip_filter_engines.items():
+            result = engine(x, args.threshold, 0.9, 1.1)  # warm up caches
+            seconds = timeit.timeit(lambda: engine(x, args.threshold, 0.9, 1.1), number=args.repeat) / args.repeat
+            error = (result - reference).abs().max().item()
+            print(f"{str(shape):<24}{name:<10}{seconds * 1000:>10.2f}{error:>14.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Minimal stand-ins for the webui `modules` package, so that lib_free_u can be imported without a webui install.
+Only what lib_free_u touches at import time and in the hot path is provided.
+"""
+import pathlib
+import sys
+import types
+
+
+REPO_ROOT = pathlib.Path(__file__).parent.parent
+
+
+def install():
+    if "modules" in sys.modules:
+        return
+
+    modules = types.ModuleType("modules")
+
+    shared = types.ModuleType("modules.shared")
+    shared.opts = types.SimpleNamespace(data={})
+    shared.state = types.SimpleNamespace(sampling_steps=20, sampling_step=0)
+
+    scripts = types.ModuleType("modules.scripts")
+    scripts.basedir = lambda: str(REPO_ROOT)
+    scripts.scripts_data = []
+
+    for name, module in {"shared": shared, "scripts": scripts}.items():
+        setattr(modules, name, module)
+        sys.modules[f"modules.{name}"] = module
+    sys.modules["modules"] = modules
+
+    if str(REPO_ROOT) not in sys.path:
+        sys.path.insert(0, str(REPO_ROOT))
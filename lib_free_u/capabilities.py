@@ -0,0 +1,59 @@
+import pathlib
+import sys
+from typing import Optional
+import torch
+from lib_free_u import preset_store
+
+
+CAPABILITIES_PATH = pathlib.Path(__file__).parent.parent / "capabilities.json"
+
+# one record per torch version and device name, shared by every webui process using this extension directory
+store = preset_store.PresetStore(CAPABILITIES_PATH, defaults={}, factory=dict, to_dict=dict)
+refreshed = False
+
+
+def get_device_key(device: torch.device) -> str:
+    if device.type == "cuda":
+        device_name = torch.cuda.get_device_name(device)
+    else:
+        device_name = device.type
+
+    return f"torch {torch.__version__} {device_name}"
+
+
+def get_record(device: torch.device) -> dict:
+    global refreshed
+
+    if not refreshed:
+        store.refresh()
+        refreshed = True
+
+    return store.get(get_device_key(device), {})
+
+
+def update_record(device: torch.device, section: str, key: str, value):
+    def update(record: Optional[dict]) -> dict:
+        record = record or {}
+        return {**record, section: {**record.get(section, {}), key: value}}
+
+    try:
+        store.update_preset(get_device_key(device), update)
+    except OSError as e:
+        # read only installs still work, they probe again after each restart
+        print("[sd-webui-freeu]", f"Could not save device capabilities: {e}", file=sys.stderr)
+
+
+def get_fft_support(device: torch.device, dtype: torch.dtype) -> Optional[bool]:
+    return get_record(device).get("fft", {}).get(str(dtype))
+
+
+def set_fft_support(device: torch.device, dtype: torch.dtype, supported: bool):
+    update_record(device, "fft", str(dtype), supported)
+
+
+def get_fastest_engine(device: torch.device, key: str) -> Optional[str]:
+    return get_record(device).get("fastest_engines", {}).get(key)
+
+
+def set_fastest_engine(device: torch.device, key: str, engine_name: str):
+    update_record(device, "fastest_engines", key, engine_name)
@@ -1,36 +1,82 @@
+import collections
+import contextvars
 import dataclasses
 import inspect
 import json
 import pathlib
 import re
 import sys
-from typing import Union, List, Any
+import threading
+from typing import Union, List, Any, Callable, Dict, Optional, Tuple
+from lib_free_u import preset_store
+
+
+# [position, value] pairs, see unet.interpolate_keyframes
+Keyframes = List[List[Union[float, int]]]
+
+
+def to_keyframes(name: str, keyframes) -> Keyframes:
+    keyframes = [list(keyframe) if isinstance(keyframe, (list, tuple)) else keyframe for keyframe in keyframes]
+    if not keyframes:
+        raise ValueError(f"{name} keyframes cannot be empty")
+
+    for keyframe in keyframes:
+        if not isinstance(keyframe, list) or len(keyframe) != 2 or not all(isinstance(n, (float, int)) and not isinstance(n, bool) for n in keyframe):
+            raise ValueError(f"{name} keyframes must be [position, value] pairs of numbers, got {keyframe!r}")
+
+    return keyframes
 
 
 @dataclasses.dataclass
 class StageInfo:
-    backbone_factor: float = 1.0
-    skip_factor: float = 1.0
-    backbone_offset: float = 0.0
-    backbone_width: float = 0.5
-    skip_cutoff: float = 0.0
-    skip_high_end_factor: float = 1.0
+    # any field can also be a keyframes list, to change over the course of sampling
+    backbone_factor: Union[float, Keyframes] = 1.0
+    skip_factor: Union[float, Keyframes] = 1.0
+    backbone_offset: Union[float, Keyframes] = 0.0
+    backbone_width: Union[float, Keyframes] = 0.5
+    skip_cutoff: Union[float, Keyframes] = 0.0
+    skip_high_end_factor: Union[float, Keyframes] = 1.0
     # <- add new fields at the end here for png info backwards compatibility
 
+    def __post_init__(self):
+        for k, v in vars(self).items():
+            if isinstance(v, (list, tuple)):
+                setattr(self, k, to_keyframes(k, v))
+
     def to_dict(self, include_default=False):
-        default_stage_info = StageInfo()
         res = vars(self).copy()
-        for k, v in res.copy().items():
-            if not include_default and v == getattr(default_stage_info, k):
-                del res[k]
+        if not include_default:
+            for k, v in vars(self).items():
+                if v == STAGE_INFO_DEFAULTS[k]:
+                    del res[k]
 
         return res
 
     def copy(self):
         return StageInfo(**vars(self))
 
+    @property
+    def is_keyframed(self) -> bool:
+        return any(isinstance(v, list) for v in vars(self).values())
+
+    @property
+    def kind(self) -> str:
+        """
+        "identity", "backbone", "skip" or "full", depending on which parts of the stage have an effect.
+        """
+        has_backbone = self.backbone_factor != 1
+        has_skip = self.skip_factor != 1 or self.skip_high_end_factor != 1
+        if has_backbone and has_skip:
+            return "full"
+        if has_backbone:
+            return "backbone"
+        if has_skip:
+            return "skip"
+        return "identity"
+
 
 STAGE_INFO_ARGS_LEN = len(inspect.getfullargspec(StageInfo.__init__)[0]) - 1  # off by one because of self
+STAGE_INFO_DEFAULTS = {field.name: field.default for field in dataclasses.fields(StageInfo)}
 STAGES_COUNT = 3
 shorthand_re = re.compile(r"^([a-z]{1,2})([0-9]+)$")
 all_versions = {
@@ -42,10 +88,6 @@ reversed_all_versions = {
     for k, v in all_versions.items()
 }
 
-xyz_attrs: dict = {}
-current_sampling_step: float = 0
-
-
 @dataclasses.dataclass
 class State:
     enable: bool = True
@@ -54,10 +96,15 @@ class State:
     transition_smoothness: float = 0.0
     version: str = "1"
     stage_infos: List[Union[StageInfo, dict, Any]] = dataclasses.field(default_factory=lambda: [StageInfo() for _ in range(STAGES_COUNT)])
+    # <- fields below are not passed by the ui, add new ones at the end
+    schedule_curve: str = "linear"
+    schedule_keyframes: Optional[Keyframes] = None
 
     def __post_init__(self):
         self.stage_infos = self.group_stage_infos()
         self.version = self.format_version()
+        if self.schedule_keyframes is not None:
+            self.schedule_keyframes = to_keyframes("schedule", self.schedule_keyframes)
 
     def group_stage_infos(self):
         res = []
@@ -89,10 +136,15 @@ class State:
         result = vars(self).copy()
         result["stage_infos"] = [stage_info.to_dict() for stage_info in result["stage_infos"]]
         del result["enable"]
+        # keep presets and infotexts readable by older versions when the newer fields are unused
+        if result["schedule_curve"] == "linear":
+            del result["schedule_curve"]
+        if result["schedule_keyframes"] is None:
+            del result["schedule_keyframes"]
         return result
 
     def copy(self):
-        self_vars = vars(self)
+        self_vars = vars(self).copy()
         old_stage_infos = self_vars["stage_infos"]
         self_vars["stage_infos"] = old_stage_infos.copy()
         for i, stage_info in enumerate(old_stage_infos):
@@ -120,12 +172,37 @@ class State:
             self.__dict__[key] = value
 
 
-def apply_xyz():
-    global instance
-
+@dataclasses.dataclass
+class GenerationState:
+    instance: State = dataclasses.field(default_factory=State)
+    plan: Optional[Any] = None
+    base_plan: Optional[Any] = None
+    hires_plan: Optional[Any] = None
+    current_sampling_step: float = 0
+    sampling_steps: Optional[int] = None
+    sigma_steps: Optional[Any] = None
+    xyz_attrs: dict = dataclasses.field(default_factory=dict)
+    hooked_model: Optional[Any] = None
+    profiler: Optional[Any] = None
+    unet_call_index: int = 0
+    sweep_fingerprint: Optional[str] = None
+    # all the values of each FreeU xyz axis, and the xyz attrs of each sample when a FreeU axis runs as one batch
+    xyz_axis_values: dict = dataclasses.field(default_factory=dict)
+    xyz_batch_attrs: Optional[List[dict]] = None
+
+    def apply_xyz(self):
+        if not self.xyz_attrs:
+            return
+
+        self.instance = apply_xyz_attrs(self.instance, self.xyz_attrs)
+
+
+def apply_xyz_attrs(state: State, xyz_attrs: dict) -> State:
+    # the state can be shared through state_cache, change a copy
+    state = state.copy()
     if preset_key := xyz_attrs.get("preset"):
         if preset := all_presets.get(preset_key):
-            instance = preset.copy()
+            state = preset.copy()
         elif preset_key != "UI Settings":
             print("[sd-webui-freeu]", f"XYZ Preset '{preset_key}' does not exist", file=sys.stderr)
 
@@ -133,13 +210,78 @@ def apply_xyz():
         if k == "preset":
             continue
 
-        instance.update_attr(k, v)
+        state.update_attr(k, v)
+
+    return state
+
+
+class StateCache:
+    """
+    States parsed from recent api arg dicts, keyed by their json, and the infotext of each.
+    Cached States are shared between generations: copy them before changing them.
+    """
 
+    def __init__(self, maxsize: int = 64):
+        self.maxsize = maxsize
+        self.states: collections.OrderedDict[str, State] = collections.OrderedDict()
+        self.infotexts: Dict[Tuple[int, Callable], dict] = {}
+        self.lock = threading.Lock()
 
-STATE_ARGS_LEN = len(inspect.getfullargspec(State.__init__)[0]) - 1  # off by one because of self
+    def get_state(self, state_dict: dict) -> State:
+        try:
+            key = json.dumps(state_dict, sort_keys=True)
+        except TypeError:
+            return State(**state_dict)
+
+        with self.lock:
+            state = self.states.get(key)
+            if state is not None:
+                self.states.move_to_end(key)
+                return state
+
+        state = State(**state_dict)
+        with self.lock:
+            self.states[key] = state
+            if len(self.states) > self.maxsize:
+                _, evicted_state = self.states.popitem(last=False)
+                for infotext_key in [k for k in self.infotexts if k[0] == id(evicted_state)]:
+                    del self.infotexts[infotext_key]
+
+        return state
+
+    def get_infotext(self, state: State, build_infotext: Callable[[State], dict]) -> dict:
+        key = id(state), build_infotext
+        infotext = self.infotexts.get(key)
+        if infotext is None:
+            infotext = build_infotext(state)
+            with self.lock:
+                # ids are only stable for the states the cache keeps alive
+                if any(state is cached_state for cached_state in self.states.values()):
+                    self.infotexts[key] = infotext
+
+        return infotext
+
+
+state_cache = StateCache()
+
+
+# each generation runs in its own context, so concurrent api requests do not share FreeU state
+generation_state_var: contextvars.ContextVar[GenerationState] = contextvars.ContextVar("free_u_generation_state")
+
+
+def get_generation_state() -> GenerationState:
+    try:
+        return generation_state_var.get()
+    except LookupError:
+        generation_state = GenerationState()
+        generation_state_var.set(generation_state)
+        return generation_state
+
+
+# number of positional args the ui passes, up to and including the stage infos
+STATE_ARGS_LEN = [field.name for field in dataclasses.fields(State)].index("stage_infos") + 1
 PRESETS_PATH = pathlib.Path(__file__).parent.parent / "presets.json"
 
-instance = State()
 default_presets = {
     "SD1.4 Recommendations": State(
         stage_infos=[
@@ -163,39 +305,35 @@ default_presets = {
         ],
     ),
 }
-all_presets = {}
+# assigning or deleting a key saves that preset to PRESETS_PATH right away
+all_presets = preset_store.PresetStore(
+    PRESETS_PATH,
+    defaults=default_presets,
+    factory=lambda preset_dict: State(**preset_dict),
+    to_dict=lambda state: state.to_dict(),
+)
 
 
 def reload_presets():
-    all_presets.clear()
-    all_presets.update(default_presets)
-    all_presets.update(load_presets())
+    # cheap when the file did not change
+    all_presets.refresh()
 
 
 def load_presets():
-    if not PRESETS_PATH.exists():
-        return []
-
-    with open(PRESETS_PATH, "r") as f:
-        return {
-            k: State(**v)
-            for k, v in json.load(f).items()
-        }
+    reload_presets()
+    return get_user_presets()
 
 
 def save_presets(presets=None):
     if presets is None:
         presets = get_user_presets()
 
-    presets = {k: v.to_dict() for k, v in presets.items()}
-
-    with open(PRESETS_PATH, "w") as f:
-        json.dump(presets, f, indent=4)
+    all_presets.set_presets(presets)
 
 
 def get_user_presets():
     return {
-        k: v
-        for k, v in all_presets.items()
+        k: all_presets[k]
+        for k in all_presets.user_keys()
         if k not in default_presets
     }
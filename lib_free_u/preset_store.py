@@ -0,0 +1,166 @@
+import collections.abc
+import contextlib
+import json
+import os
+import pathlib
+import tempfile
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class PresetStore(collections.abc.MutableMapping):
+    """
+    Default presets followed by the user presets of a json file that several webui processes can share.
+    The file is parsed again only when its mtime or size changes, and each preset is built on first access.
+    Writes hold a lock on the file and only change the affected preset, so concurrent processes keep each other's presets.
+    """
+
+    def __init__(self, path: pathlib.Path, defaults: Dict[str, Any], factory: Callable[[dict], Any], to_dict: Callable[[Any], dict]):
+        self.path = path
+        self.lock_path = path.with_name(path.name + ".lock")
+        self.defaults = defaults
+        self.factory = factory
+        self.to_dict = to_dict
+        self.raw_presets: Dict[str, dict] = {}
+        self.presets: Dict[str, Any] = {}
+        self.file_signature: Optional[Tuple[int, int, int]] = None
+
+    def refresh(self):
+        signature = self.get_file_signature()
+        if signature == self.file_signature:
+            return
+
+        raw_presets = self.read_file()
+        # presets that did not change on disk keep their materialized object
+        self.presets = {
+            k: v
+            for k, v in self.presets.items()
+            if k in raw_presets and raw_presets[k] == self.raw_presets.get(k)
+        }
+        self.raw_presets = raw_presets
+        self.file_signature = signature
+
+    def user_keys(self):
+        return self.raw_presets.keys()
+
+    def __getitem__(self, key: str):
+        if key in self.presets:
+            return self.presets[key]
+
+        if key in self.raw_presets:
+            preset = self.presets[key] = self.factory(self.raw_presets[key])
+            return preset
+
+        return self.defaults[key]
+
+    def __setitem__(self, key: str, preset):
+        raw_preset = self.to_dict(preset)
+        with self.locked():
+            self.refresh()
+            self.raw_presets[key] = raw_preset
+            self.write_file()
+
+        self.presets[key] = preset
+
+    def update_preset(self, key: str, function: Callable[[Optional[Any]], Any]):
+        """
+        Replaces the preset at key with function(preset), where preset is read from the file under the lock, or None if missing.
+        """
+        with self.locked():
+            self.refresh()
+            preset = function(self.get(key))
+            self.raw_presets[key] = self.to_dict(preset)
+            self.write_file()
+
+        self.presets[key] = preset
+
+    def __delitem__(self, key: str):
+        if key not in self.raw_presets:
+            raise KeyError(key)
+
+        with self.locked():
+            self.refresh()
+            self.raw_presets.pop(key, None)
+            self.write_file()
+
+        self.presets.pop(key, None)
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self.defaults
+        yield from (k for k in self.raw_presets if k not in self.defaults)
+
+    def __len__(self) -> int:
+        return len(self.defaults) + sum(1 for k in self.raw_presets if k not in self.defaults)
+
+    def __contains__(self, key) -> bool:
+        return key in self.raw_presets or key in self.defaults
+
+    def set_presets(self, presets: Dict[str, Any]):
+        """
+        Writes several presets at once. Presets of the file that are not in presets are kept, including those of other processes.
+        """
+        raw_presets = {k: self.to_dict(v) for k, v in presets.items()}
+        with self.locked():
+            self.refresh()
+            self.raw_presets.update(raw_presets)
+            self.write_file()
+
+        self.presets.update(presets)
+
+    def get_file_signature(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def read_file(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def write_file(self):
+        # write next to the file and rename over it, readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.name, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.raw_presets, f, indent=4)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(temp_path)
+            raise
+
+        self.file_signature = self.get_file_signature()
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lock_path, "a+") as lock_file:
+            lock_file_descriptor(lock_file.fileno())
+            try:
+                yield
+            finally:
+                unlock_file_descriptor(lock_file.fileno())
+
+
+def lock_file_descriptor(fd: int):
+    if os.name == "nt":
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+
+def unlock_file_descriptor(fd: int):
+    if os.name == "nt":
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
@@ -0,0 +1,121 @@
+import collections
+import dataclasses
+import time
+from typing import Deque, Dict, List, Tuple
+import torch
+
+
+modes = ["off", "wall", "events"]
+recent_profiles: Deque[dict] = collections.deque(maxlen=16)
+
+
+@dataclasses.dataclass
+class StageProfile:
+    calls: int = 0
+    filter_calls: int = 0
+    filter_fast_exits: int = 0
+    seconds: float = 0.0
+    # memory still allocated at the end of the stage, summed over all calls
+    bytes_allocated: int = 0
+    # largest memory use above the start of the stage, over the calls that raised the peak of the device
+    peak_bytes_allocated: int = 0
+    pending_events: List[Tuple[torch.cuda.Event, torch.cuda.Event]] = dataclasses.field(default_factory=list)
+
+    def to_dict(self) -> dict:
+        for start_event, end_event in self.pending_events:
+            end_event.synchronize()
+            self.seconds += start_event.elapsed_time(end_event) / 1000
+        self.pending_events.clear()
+
+        return {
+            "calls": self.calls,
+            "filter_calls": self.filter_calls,
+            "filter_fast_exits": self.filter_fast_exits,
+            "ms": round(self.seconds * 1000, 3),
+            "bytes_allocated": self.bytes_allocated,
+            "peak_bytes_allocated": self.peak_bytes_allocated,
+        }
+
+
+class Profiler:
+    """
+    Per-stage counters and timings of the FreeU output block hooks for one generation.
+    "wall" synchronizes the device around each stage and measures with perf_counter.
+    "events" records cuda events instead and only synchronizes when the summary is requested. it behaves like "wall" on other devices.
+    Memory is read from the allocator of torch without resetting its peak stats, so the peak memory reported by webui is unchanged.
+    """
+
+    def __init__(self, mode: str = "wall"):
+        self.mode = mode
+        self.stages: Dict[int, StageProfile] = {}
+        self.fast_exits = 0
+
+    def record_fast_exit(self):
+        self.fast_exits += 1
+
+    def start(self, h: torch.Tensor) -> tuple:
+        device = h.device
+        memory = 0, 0
+        if device.type == "cuda":
+            memory = torch.cuda.memory_allocated(device), torch.cuda.max_memory_allocated(device)
+        if self.mode == "events" and device.type == "cuda":
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record()
+            return start_event, memory
+
+        synchronize(device)
+        return time.perf_counter(), memory
+
+    def stop(self, start: tuple, stage_index: int, h: torch.Tensor, filter_result: str):
+        """
+        filter_result is "not run" for backbone only stages, "identity" when the skip filter exited early and "filtered" otherwise.
+        """
+        stage = self.stages.setdefault(stage_index, StageProfile())
+        stage.calls += 1
+        if filter_result == "filtered":
+            stage.filter_calls += 1
+        elif filter_result == "identity":
+            stage.filter_fast_exits += 1
+
+        begin, memory = start
+        device = h.device
+        if isinstance(begin, torch.cuda.Event):
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record()
+            stage.pending_events.append((begin, end_event))
+        else:
+            synchronize(device)
+            stage.seconds += time.perf_counter() - begin
+
+        if device.type == "cuda":
+            memory_allocated, max_memory_allocated = memory
+            stage.bytes_allocated += torch.cuda.memory_allocated(device) - memory_allocated
+            # below the peak of the device, the peak of the stage cannot be told apart from earlier allocations
+            peak = torch.cuda.max_memory_allocated(device)
+            if peak > max_memory_allocated:
+                stage.peak_bytes_allocated = max(stage.peak_bytes_allocated, peak - memory_allocated)
+
+    def summary(self) -> dict:
+        return {
+            "mode": self.mode,
+            "fast_exits": self.fast_exits,
+            "stages": {
+                str(stage_index + 1): self.stages[stage_index].to_dict()
+                for stage_index in sorted(self.stages)
+            },
+        }
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        stages = ", ".join(
+            f"stage {stage_n}: {stage['calls']} calls {stage['ms']}ms"
+            for stage_n, stage in summary["stages"].items()
+        )
+        return f"{stages}; {summary['fast_exits']} fast exits"
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
@@ -0,0 +1,82 @@
+import bisect
+import functools
+import sys
+from typing import Dict, List, Optional, Sequence
+from lib_free_u import global_state
+
+
+# samplers whose corrector evaluates the model exactly at the sigma of the next step, right before that step evaluates it again
+CORRECTOR_SAMPLERS = {"sample_heun", "sample_heunpp2"}
+
+
+class SigmaSteps:
+    """
+    Maps the sigma of a denoiser call to the sampler step it belongs to.
+    Second order samplers evaluate the model several times per step, so counting calls drifts. Sigmas do not.
+    Heun is the exception: its corrector runs at the sigma of the next step, so with corrector_at_next_sigma, the call order decides instead.
+    """
+
+    def __init__(self, sigmas: Sequence[float], corrector_at_next_sigma: bool = False):
+        self.sigmas = [float(sigma) for sigma in sigmas]
+        self.negated_sigmas = [-sigma for sigma in self.sigmas]
+        self.first_index: Optional[int] = None
+        self.steps_cache: Dict[float, int] = {}
+        self.corrector_at_next_sigma = corrector_at_next_sigma
+        self.last_sigma: Optional[float] = None
+        self.last_step = 0
+
+    @property
+    def steps(self) -> int:
+        return len(self.sigmas) - 1 - (self.first_index or 0)
+
+    def get_step(self, sigma: float) -> int:
+        if self.corrector_at_next_sigma:
+            # within a step, sigmas decrease. a sigma that does not decrease starts the next step
+            if self.last_sigma is None or sigma >= self.last_sigma:
+                self.last_step = self.compute_step(sigma)
+            self.last_sigma = sigma
+            return self.last_step
+
+        step = self.steps_cache.get(sigma)
+        if step is None:
+            step = self.steps_cache[sigma] = self.compute_step(sigma)
+
+        return step
+
+    def compute_step(self, sigma: float) -> int:
+        # the schedule is decreasing. a sigma belongs to the last step whose sigma is not below it.
+        # this puts intermediate evaluations (dpm2, dpm++ 2s, ...) on the step they are taken from
+        index = bisect.bisect_right(self.negated_sigmas, -sigma * (1 - 1e-4)) - 1
+        index = min(max(index, 0), len(self.sigmas) - 1)
+
+        # img2img only samples the tail of the schedule. count steps from the first sigma seen
+        if self.first_index is None:
+            self.first_index = index
+
+        return max(0, index - self.first_index)
+
+
+def replay(sigmas: Sequence[float], denoiser_sigmas: Sequence[float], corrector_at_next_sigma: bool = False) -> List[int]:
+    """
+    Offline helper: returns the step that each recorded denoiser sigma is attributed to.
+    """
+    sigma_steps = SigmaSteps(sigmas, corrector_at_next_sigma)
+    return [sigma_steps.get_step(float(sigma)) for sigma in denoiser_sigmas]
+
+
+def patch():
+    try:
+        from modules import sd_samplers_kdiffusion
+    except ImportError:
+        print("[sd-webui-freeu]", "k-diffusion samplers not found, falling back to counting denoiser calls", file=sys.stderr)
+        return
+
+    sampler_class = sd_samplers_kdiffusion.KDiffusionSampler
+    sampler_class.get_sigmas = functools.partialmethod(get_sigmas_hijack, original_function=sampler_class.get_sigmas)
+
+
+def get_sigmas_hijack(self, p, steps, *args, original_function, **kwargs):
+    sigmas = original_function(self, p, steps, *args, **kwargs)
+    sampler_function_name = getattr(getattr(self, "func", None), "__name__", None)
+    global_state.get_generation_state().sigma_steps = SigmaSteps(sigmas.tolist(), sampler_function_name in CORRECTOR_SAMPLERS)
+    return sigmas
@@ -0,0 +1,205 @@
+import dataclasses
+import functools
+import hashlib
+import threading
+import weakref
+from typing import Any, Dict, Optional, Tuple
+import numpy as np
+import torch
+from lib_free_u import global_state
+from modules import shared
+
+
+class SweepCache:
+    """
+    UNet results of the calls where FreeU has no effect, kept from one generation to the next.
+    In an xyz sweep, cells that only change FreeU settings sample the same latents until FreeU becomes active,
+    so they reuse these results instead of running the UNet again. All forward inputs are compared before reusing a result.
+    Weights and extension state are not forward inputs: results are only reused between generations with the same fingerprint, see get_fingerprint.
+    """
+
+    def __init__(self):
+        self.fingerprint: Optional[str] = None
+        # (call index in the pass, input shape) -> (args, kwargs, output)
+        self.entries: Dict[Tuple[int, torch.Size], Tuple[tuple, dict, Any]] = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def set_fingerprint(self, fingerprint: str):
+        with self.lock:
+            if fingerprint != self.fingerprint:
+                self.entries.clear()
+                self.fingerprint = fingerprint
+
+    def get(self, key, args: tuple, kwargs: dict):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None or not are_inputs_equal(entry[0], args) or not are_inputs_equal(entry[1], kwargs):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key, args: tuple, kwargs: dict, output):
+        with self.lock:
+            self.entries[key] = detach(args), detach(kwargs), detach(output)
+
+    def clear(self):
+        with self.lock:
+            self.fingerprint = None
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+cache = SweepCache()
+installed_models: "weakref.WeakKeyDictionary[torch.nn.Module, bool]" = weakref.WeakKeyDictionary()
+install_lock = threading.Lock()
+
+
+def install(diffusion_model: torch.nn.Module):
+    with install_lock:
+        if diffusion_model in installed_models:
+            return
+
+        original_forward = diffusion_model.forward
+        diffusion_model.forward = functools.partial(cached_forward, original_forward=original_forward)
+        installed_models[diffusion_model] = True
+
+
+def uninstall_all():
+    with install_lock:
+        for diffusion_model in list(installed_models.keys()):
+            # the instance attribute shadows the class forward, removing it restores the original
+            if isinstance(vars(diffusion_model).get("forward"), functools.partial):
+                del diffusion_model.forward
+        installed_models.clear()
+
+
+def cached_forward(*args, original_forward, **kwargs):
+    generation_state = global_state.get_generation_state()
+    call_index = generation_state.unet_call_index
+    generation_state.unet_call_index += 1
+    fingerprint = generation_state.sweep_fingerprint
+    if fingerprint is None or not is_before_free_u(generation_state) or not args or not isinstance(args[0], torch.Tensor):
+        return original_forward(*args, **kwargs)
+
+    cache.set_fingerprint(fingerprint)
+    key = call_index, args[0].shape
+    output = cache.get(key, args, kwargs)
+    if output is not None:
+        return detach(output)
+
+    output = original_forward(*args, **kwargs)
+    cache.put(key, args, kwargs, output)
+    return output
+
+
+def is_before_free_u(generation_state: global_state.GenerationState) -> bool:
+    # once FreeU has been active, the latents of cells with other FreeU settings differ, even after stop_ratio
+    # results of later calls could never be reused, so they are not cached
+    plan = generation_state.plan
+    if plan is None:
+        return True
+
+    steps = generation_state.sampling_steps or shared.state.sampling_steps
+    first_active_step = plan.get_first_active_step(steps)
+    return first_active_step is None or int(generation_state.current_sampling_step) < first_active_step
+
+
+# settings that change the UNet output without changing its inputs
+# other settings of webui or extensions that do the same are not covered, turn the cache off when sweeping them
+UNET_OPTIONS = [
+    "sd_unet",
+    "cross_attention_optimization",
+    "upcast_attn",
+    "token_merging_ratio",
+    "token_merging_ratio_hr",
+    "token_merging_ratio_img2img",
+    "extra_networks_default_multiplier",
+    "lora_functional",
+]
+
+
+def get_fingerprint(p, own_args_range: Tuple[int, int] = (0, 0)) -> str:
+    """
+    Hash of what changes the UNet without changing its inputs: the checkpoint, the raw prompts with their extra networks,
+    UNET_OPTIONS, settings overrides and the args of other scripts. Values without a stable representation make the fingerprint unique, so nothing is reused.
+    """
+    script_args = list(getattr(p, "script_args", None) or [])
+    own_args_from, own_args_to = own_args_range
+    checkpoint_info = getattr(shared.sd_model, "sd_checkpoint_info", None)
+    values = [
+        getattr(checkpoint_info, "filename", None),
+        p.prompt,
+        p.negative_prompt,
+        {option: shared.opts.data.get(option) for option in UNET_OPTIONS},
+        getattr(p, "override_settings", None),
+        script_args[:own_args_from] + script_args[own_args_to:],
+    ]
+
+    digest = hashlib.sha256()
+    update_fingerprint(digest, values)
+    return digest.hexdigest()
+
+
+def update_fingerprint(digest, value):
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().numpy()
+
+    if isinstance(value, np.ndarray):
+        digest.update(f"ndarray{value.shape}{value.dtype}".encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for v in value:
+            update_fingerprint(digest, v)
+    elif isinstance(value, dict):
+        digest.update(f"dict{len(value)}".encode())
+        for k, v in value.items():
+            update_fingerprint(digest, k)
+            update_fingerprint(digest, v)
+    elif dataclasses.is_dataclass(value) and not isinstance(value, type):
+        digest.update(type(value).__qualname__.encode())
+        update_fingerprint(digest, {field.name: getattr(value, field.name) for field in dataclasses.fields(value)})
+    elif value is None or isinstance(value, (bool, int, float, str, bytes)):
+        digest.update(repr(value).encode())
+    else:
+        # no stable representation, never match another generation
+        digest.update(f"{type(value).__qualname__}{id(value)}".encode())
+
+
+def are_inputs_equal(a, b) -> bool:
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return (
+            isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor)
+            and a.shape == b.shape and a.dtype == b.dtype and a.device == b.device
+            and torch.equal(a, b)
+        )
+
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(are_inputs_equal(x, y) for x, y in zip(a, b))
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(are_inputs_equal(a[k], b[k]) for k in a)
+
+    try:
+        return bool(a == b)
+    except Exception:
+        return False
+
+
+def detach(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().clone()
+
+    if isinstance(value, (list, tuple)):
+        return type(value)(detach(v) for v in value)
+
+    if isinstance(value, dict):
+        return {k: detach(v) for k, v in value.items()}
+
+    return value
@@ -1,99 +1,545 @@
+import bisect
+import dataclasses
 import functools
 import math
-import pathlib
 import sys
-from typing import Tuple, Union, Optional
-from lib_free_u import global_state
-from modules import scripts, shared
-from modules.sd_hijack_unet import th
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+from lib_free_u import capabilities, global_state, profiling
+from modules import shared
 import torch
 
 
-def patch():
-    th.cat = functools.partial(free_u_cat_hijack, original_function=th.cat)
+hooks_lock = threading.Lock()
+# diffusion model -> [hook handles, number of generations using them]
+installed_hooks: "weakref.WeakKeyDictionary[torch.nn.Module, list]" = weakref.WeakKeyDictionary()
 
-    cn_script_paths = [
-        str(pathlib.Path(scripts.basedir()).parent.parent / "extensions-builtin" / "sd-webui-controlnet"),
-        str(pathlib.Path(scripts.basedir()).parent / "sd-webui-controlnet"),
-    ]
-    sys.path[0:0] = cn_script_paths
-    cn_status = "enabled"
-    try:
-        import scripts.hook as controlnet_hook
-    except ImportError:
-        cn_status = "disabled"
-    else:
-        controlnet_hook.th.cat = functools.partial(free_u_cat_hijack, original_function=controlnet_hook.th.cat)
-    finally:
-        for p in cn_script_paths:
-            sys.path.remove(p)
 
-        print("[sd-webui-freeu]", f"Controlnet support: *{cn_status}*")
+def install_hooks(diffusion_model: Optional[torch.nn.Module]) -> bool:
+    """
+    Attach FreeU to the output blocks of the unet. Every caller of the blocks goes through the hooks,
+    including the webui unet forward and the controlnet one, so no concat has to be intercepted.
+    """
+    layout = get_stage_layout(diffusion_model)
+    if not layout.block_stages:
+        return False
 
+    with hooks_lock:
+        entry = installed_hooks.get(diffusion_model)
+        if entry is None:
+            handles = [
+                block.register_forward_pre_hook(functools.partial(
+                    free_u_output_block_hook,
+                    backbone_channels=layout.stage_channels[stage_index],
+                ))
+                for block, stage_index in zip(diffusion_model.output_blocks, layout.block_stages)
+            ]
+            entry = installed_hooks[diffusion_model] = [handles, 0]
 
-def free_u_cat_hijack(hs, *args, original_function, **kwargs):
-    if not global_state.instance.enable:
-        return original_function(hs, *args, **kwargs)
+        entry[1] += 1
 
-    schedule_ratio = get_schedule_ratio()
-    if schedule_ratio == 0:
-        return original_function(hs, *args, **kwargs)
+    return True
 
-    try:
-        h, h_skip = hs
-        if list(kwargs.keys()) != ["dim"] or kwargs.get("dim", -1) != 1:
-            return original_function(hs, *args, **kwargs)
-    except ValueError:
-        return original_function(hs, *args, **kwargs)
 
-    dims = h.shape[1]
+def uninstall_hooks(diffusion_model: torch.nn.Module):
+    with hooks_lock:
+        entry = installed_hooks.get(diffusion_model)
+        if entry is None:
+            return
+
+        entry[1] -= 1
+        if entry[1] > 0:
+            # a concurrent generation still needs them
+            return
+
+        for handle in entry[0]:
+            handle.remove()
+        del installed_hooks[diffusion_model]
+
+
+def free_u_output_block_hook(_block, args, backbone_channels: int):
+    generation_state = global_state.get_generation_state()
+    plan = generation_state.plan
+    if plan is None:
+        return None
+
+    profiler = generation_state.profiler
+    stage_plan = plan.stages.get(backbone_channels)
+    if stage_plan is None or stage_plan.kind == "identity":
+        if profiler is not None:
+            profiler.record_fast_exit()
+        return None
+
+    steps = generation_state.sampling_steps or shared.state.sampling_steps
+    stages_factors = plan.get_stages_factors(int(generation_state.current_sampling_step), steps)
+    if stages_factors is None:
+        if profiler is not None:
+            profiler.record_fast_exit()
+        return None
+
+    # the block input is the fresh concat of the backbone and the skip connection, it can be modified in place
+    x = args[0]
+    h, h_skip = x[:, :backbone_channels], x[:, backbone_channels:]
+
+    if profiler is not None:
+        profiler_start = profiler.start(h)
+
+    stage_factors = stages_factors[stage_plan.index]
+    if stage_plan.kind != "skip":
+        if plan.batched:
+            scale_backbone_batched(h, stage_factors.backbone_factor, stage_plan.get_backbone_mask(h, stage_factors), plan.versions)
+        else:
+            scale = get_backbone_scale(h, stage_factors.backbone_factor, plan.version)
+            for channels in stage_factors.backbone_slices[0]:
+                h[:, channels] *= scale
+
+    filter_result = "not run"
+    if stage_plan.kind != "backbone":
+        plan.prepare_skip_filters(stage_plan, steps, h_skip)
+        h_skip_filtered = filter_skip(
+            h_skip,
+            threshold=stage_factors.skip_cutoff,
+            scale=stage_factors.skip_factor,
+            scale_high=stage_factors.skip_high_end_factor,
+            cache=stage_factors.skip_filter_data,
+        )
+        if h_skip_filtered is h_skip:
+            filter_result = "identity"
+        else:
+            filter_result = "filtered"
+            h_skip.copy_(h_skip_filtered)
+
+    if profiler is not None:
+        profiler.stop(profiler_start, stage_plan.index, h, filter_result)
+
+    return None
+
+
+@dataclasses.dataclass(frozen=True)
+class StageLayout:
+    # backbone channels of each decoder stage, in decoder order
+    stage_channels: Tuple[int, ...]
+    # stage index of each output block
+    block_stages: Tuple[int, ...] = ()
+
+    @property
+    def stages_count(self) -> int:
+        return len(self.stage_channels)
+
+
+default_stage_layout = StageLayout(stage_channels=(1280, 640, 320))
+stage_layouts: "weakref.WeakKeyDictionary[torch.nn.Module, StageLayout]" = weakref.WeakKeyDictionary()
+
+
+def get_diffusion_model() -> Optional[torch.nn.Module]:
+    return getattr(getattr(shared.sd_model, "model", None), "diffusion_model", None)
+
+
+def get_stage_layout(diffusion_model: Optional[torch.nn.Module]) -> StageLayout:
+    if diffusion_model is None:
+        return default_stage_layout
+
+    layout = stage_layouts.get(diffusion_model)
+    if layout is None:
+        layout = stage_layouts[diffusion_model] = build_stage_layout(diffusion_model)
+
+    return layout
+
+
+def build_stage_layout(diffusion_model: torch.nn.Module) -> StageLayout:
     try:
-        index = [1280, 640, 320].index(dims)
-        stage_info = global_state.instance.stage_infos[index]
-    except ValueError:
-        stage_info = None
-
-    if stage_info is not None:
-        region_begin, region_end, region_inverted = ratio_to_region(stage_info.backbone_width, stage_info.backbone_offset, dims)
-        mask = torch.arange(dims, device=h.device)
-        mask = (region_begin <= mask) & (mask <= region_end)
-        if region_inverted:
-            mask = ~mask
-        mask = mask.reshape(1, -1, 1, 1).to(h.dtype)
-
-        scale = get_backbone_scale(
-            h,
-            backbone_factor=lerp(1, stage_info.backbone_factor, schedule_ratio),
+        previous_block = diffusion_model.middle_block
+        output_blocks = list(diffusion_model.output_blocks)
+    except AttributeError:
+        print("[sd-webui-freeu]", f"Unsupported unet {type(diffusion_model).__name__}, assuming channels {default_stage_layout.stage_channels}", file=sys.stderr)
+        return default_stage_layout
+
+    # the backbone of an output block is whatever the previous block produced
+    blocks_channels = []
+    for block in output_blocks:
+        blocks_channels.append(get_out_channels(previous_block))
+        previous_block = block
+
+    if not blocks_channels or None in blocks_channels:
+        print("[sd-webui-freeu]", f"Could not infer the unet decoder channels, assuming {default_stage_layout.stage_channels}", file=sys.stderr)
+        return default_stage_layout
+
+    stage_channels = tuple(dict.fromkeys(blocks_channels))
+    stage_indices = {channels: index for index, channels in enumerate(stage_channels)}
+    return StageLayout(
+        stage_channels=stage_channels,
+        block_stages=tuple(stage_indices[channels] for channels in blocks_channels),
+    )
+
+
+def get_out_channels(block: torch.nn.Module) -> Optional[int]:
+    for layer in reversed(list(block.children())):
+        # ResBlock, Upsample and Downsample know their output channels. SpatialTransformer keeps its input channels
+        for attribute in ("out_channels", "in_channels"):
+            channels = getattr(layer, attribute, None)
+            if isinstance(channels, int):
+                return channels
+
+    return None
+
+
+@dataclasses.dataclass(frozen=True)
+class StageFactors:
+    # tuples hold one value per batch config when the plan is batched
+    backbone_factor: Union[float, Tuple[float, ...]]
+    skip_factor: Union[float, Tuple[float, ...]]
+    skip_high_end_factor: Union[float, Tuple[float, ...]]
+    skip_cutoff: Union[float, Tuple[float, ...]]
+    # one entry per batch config
+    backbone_regions: Tuple[Tuple[int, int, bool], ...]
+    backbone_slices: Tuple[List[slice], ...]
+    # masks and projections of the skip filter for these factors, see Plan.prepare_skip_filters
+    skip_filter_data: Dict[tuple, Any] = dataclasses.field(default_factory=dict, compare=False, repr=False)
+
+
+@dataclasses.dataclass(frozen=True)
+class StagePlan:
+    index: int
+    dims: int
+    stage_infos: Tuple[global_state.StageInfo, ...]
+    backbone_regions: Tuple[Tuple[int, int, bool], ...]
+    backbone_slices: Tuple[List[slice], ...]
+    skip_cutoff: Union[float, Tuple[float, ...]]
+    # which parts of the stage have an effect for at least one config, see StageInfo.kind
+    kind: str
+    # some fields of the stage infos follow keyframes and are resolved for each step
+    keyframed: bool
+    backbone_masks: Dict[tuple, torch.Tensor] = dataclasses.field(default_factory=dict, compare=False)
+
+    @staticmethod
+    def build(index: int, dims: int, stage_infos: List[global_state.StageInfo]) -> "StagePlan":
+        # keyframed fields take their first value here. get_factors resolves them again for each step
+        first_stage_infos = [get_stage_info_at(stage_info, 0, 1) for stage_info in stage_infos]
+        backbone_regions = get_backbone_regions(first_stage_infos, dims)
+        return StagePlan(
+            index=index,
+            dims=dims,
+            stage_infos=tuple(stage_infos),
+            backbone_regions=backbone_regions,
+            backbone_slices=get_backbone_slices(backbone_regions, dims),
+            skip_cutoff=get_skip_cutoff(first_stage_infos),
+            kind=merge_stage_kinds(stage_info.kind for stage_info in stage_infos),
+            keyframed=any(stage_info.is_keyframed for stage_info in stage_infos),
         )
-        h *= mask * scale + (1 - mask)
 
-        h_skip = filter_skip(
-            h_skip,
-            threshold=stage_info.skip_cutoff,
-            scale=lerp(1, stage_info.skip_factor, schedule_ratio),
-            scale_high=lerp(1, stage_info.skip_high_end_factor, schedule_ratio),
+    def get_factors(self, schedule_ratios: List[float], step: int, steps: int) -> StageFactors:
+        stage_infos, backbone_regions, backbone_slices, skip_cutoff = self.stage_infos, self.backbone_regions, self.backbone_slices, self.skip_cutoff
+        if self.keyframed:
+            stage_infos = [get_stage_info_at(stage_info, step, steps) for stage_info in stage_infos]
+            backbone_regions = get_backbone_regions(stage_infos, self.dims)
+            if backbone_regions != self.backbone_regions:
+                backbone_slices = get_backbone_slices(backbone_regions, self.dims)
+            skip_cutoff = get_skip_cutoff(stage_infos)
+
+        factors = [
+            (
+                lerp(1, stage_info.backbone_factor, schedule_ratio),
+                lerp(1, stage_info.skip_factor, schedule_ratio),
+                lerp(1, stage_info.skip_high_end_factor, schedule_ratio),
+            )
+            for stage_info, schedule_ratio in zip(stage_infos, schedule_ratios)
+        ]
+        if len(factors) == 1:
+            return StageFactors(*factors[0], skip_cutoff, backbone_regions, backbone_slices)
+
+        return StageFactors(*zip(*factors), skip_cutoff, backbone_regions, backbone_slices)
+
+    def get_backbone_mask(self, h: torch.Tensor, stage_factors: StageFactors) -> torch.Tensor:
+        key = stage_factors.backbone_regions, h.device, h.dtype
+        if key not in self.backbone_masks:
+            mask = torch.zeros(len(stage_factors.backbone_slices), self.dims, 1, 1)
+            for config_index, slices in enumerate(stage_factors.backbone_slices):
+                for channels in slices:
+                    mask[config_index, channels] = 1
+            self.backbone_masks[key] = mask.to(device=h.device, dtype=h.dtype)
+
+        return self.backbone_masks[key]
+
+
+def get_backbone_regions(stage_infos: Iterable[global_state.StageInfo], dims: int) -> Tuple[Tuple[int, int, bool], ...]:
+    return tuple(
+        ratio_to_region(stage_info.backbone_width, stage_info.backbone_offset, dims)
+        for stage_info in stage_infos
+    )
+
+
+def get_backbone_slices(backbone_regions: Tuple[Tuple[int, int, bool], ...], dims: int) -> Tuple[List[slice], ...]:
+    return tuple(region_to_slices(*region, dims) for region in backbone_regions)
+
+
+def get_skip_cutoff(stage_infos: Iterable[global_state.StageInfo]) -> Union[float, Tuple[float, ...]]:
+    skip_cutoffs = tuple(stage_info.skip_cutoff for stage_info in stage_infos)
+    return skip_cutoffs if len(skip_cutoffs) > 1 else skip_cutoffs[0]
+
+
+def get_stage_info_at(stage_info: global_state.StageInfo, step: int, steps: int) -> global_state.StageInfo:
+    if not stage_info.is_keyframed:
+        return stage_info
+
+    return global_state.StageInfo(**{
+        k: interpolate_keyframes(v, step, steps) if isinstance(v, list) else v
+        for k, v in vars(stage_info).items()
+    })
+
+
+class Plan:
+    """
+    Everything the output block hooks need for one generation, derived once from one State per batch config.
+    Batch element i uses config i % len(states). Per-step factors are tabulated for each total number of sampling steps the first time it is seen.
+    """
+
+    def __init__(
+        self,
+        states: Union[global_state.State, List[global_state.State]],
+        steps: Optional[int] = None,
+        layout: StageLayout = default_stage_layout,
+    ):
+        if isinstance(states, global_state.State):
+            states = [states]
+        if all(state == states[0] for state in states):
+            states = states[:1]
+
+        self.states = states
+        self.state = states[0]
+        self.batched = len(states) > 1
+        self.version = self.state.version
+        self.versions = tuple(state.version for state in states)
+        self.layout = layout
+        self.stages = {
+            dims: StagePlan.build(index, dims, [get_stage_info(state, index) for state in states])
+            for index, dims in enumerate(layout.stage_channels)
+        }
+        self.schedules: Dict[int, List[Schedule]] = {}
+        self.stages_factors_tables: Dict[int, List[Optional[List[StageFactors]]]] = {}
+        self.first_active_steps: Dict[int, Optional[int]] = {}
+        self.prepared_skip_filters: Set[tuple] = set()
+        if steps is not None:
+            self.get_stages_factors_table(steps)
+
+    @property
+    def is_identity(self) -> bool:
+        return not any(state.enable for state in self.states) or all(
+            stage_plan.kind == "identity"
+            for stage_plan in self.stages.values()
         )
 
-    return original_function([h, h_skip], *args, **kwargs)
+    def get_stages_factors(self, step: int, steps: int) -> Optional[List[StageFactors]]:
+        table = self.stages_factors_tables.get(steps)
+        if table is None:
+            table = self.get_stages_factors_table(steps)
+
+        if 0 <= step < len(table):
+            return table[step]
+
+        return self.compute_stages_factors(step, steps)
+
+    def get_first_active_step(self, steps: int) -> Optional[int]:
+        if steps not in self.first_active_steps:
+            table = self.stages_factors_tables.get(steps)
+            if table is None:
+                table = self.get_stages_factors_table(steps)
+            self.first_active_steps[steps] = next((step for step, stages_factors in enumerate(table) if stages_factors is not None), None)
+
+        return self.first_active_steps[steps]
+
+    def prepare_skip_filters(self, stage_plan: StagePlan, steps: int, x: torch.Tensor):
+        """
+        Builds the skip filter data of every step of the table, the first time the stage sees this shape.
+        Keyframes and transitions change the skip params at each step, the hook then finds the data ready instead of building it.
+        """
+        key = stage_plan.index, steps, x.shape, x.device, x.dtype
+        if key in self.prepared_skip_filters:
+            return
+
+        self.prepared_skip_filters.add(key)
+        table = self.stages_factors_tables.get(steps)
+        if table is None:
+            table = self.get_stages_factors_table(steps)
+
+        # the data only depends on the batch size, the spatial size, the device and the dtype. one channel is enough to build it
+        x_channel = x[:, :1]
+        for stages_factors in table:
+            if stages_factors is None:
+                continue
+
+            f = stages_factors[stage_plan.index]
+            if is_identity_skip(f.skip_factor, f.skip_high_end_factor):
+                continue
+
+            engine = get_skip_filter_engine(x, f.skip_cutoff, f.skip_factor, f.skip_high_end_factor)
+            engine(x_channel, f.skip_cutoff, f.skip_factor, f.skip_high_end_factor, f.skip_filter_data)
+
+    def get_stages_factors_table(self, steps: int) -> List[Optional[List[StageFactors]]]:
+        self.schedules[steps] = [Schedule(state, steps) for state in self.states]
+        table = self.stages_factors_tables[steps] = [
+            self.compute_stages_factors(step, steps)
+            for step in range(steps + 1)
+        ]
+        return table
+
+    def compute_stages_factors(self, step: int, steps: int) -> Optional[List[StageFactors]]:
+        schedules = self.schedules.get(steps)
+        if schedules is None:
+            schedules = self.schedules[steps] = [Schedule(state, steps) for state in self.states]
+
+        schedule_ratios = [schedule.get_ratio(step) for schedule in schedules]
+        if not any(schedule_ratios):
+            return None
+
+        stages_factors = [None] * len(self.stages)
+        for stage_plan in self.stages.values():
+            stages_factors[stage_plan.index] = stage_plan.get_factors(schedule_ratios, step, steps)
+
+        return stages_factors
+
+
+def merge_stage_kinds(kinds: Iterable[str]) -> str:
+    kinds = set(kinds) - {"identity"}
+    if not kinds:
+        return "identity"
+    if len(kinds) == 1:
+        return kinds.pop()
+    return "full"
+
+
+def create_plan(
+    states: Union[global_state.State, List[global_state.State]],
+    steps: Optional[int] = None,
+    layout: StageLayout = default_stage_layout,
+) -> Optional[Plan]:
+    """
+    Returns None when the states would not change anything, so that the hooks can exit right away.
+    """
+    plan = Plan(states, steps, layout)
+    if plan.is_identity:
+        return None
+
+    return plan
+
+
+def get_plan_for_layout(plan: Optional[Plan], layout: StageLayout) -> Optional[Plan]:
+    # the refiner and the hires checkpoint can swap in a unet with other decoder channels during a generation
+    if plan is None or plan.layout == layout:
+        return plan
+
+    return Plan(plan.states, None, layout)
+
+
+def get_stage_info(state: global_state.State, index: int) -> global_state.StageInfo:
+    # models with more decoder stages than the ui exposes leave the extra stages untouched
+    if index < len(state.stage_infos):
+        return state.stage_infos[index]
+
+    return global_state.StageInfo(backbone_factor=1.0, skip_factor=1.0)
+
+
+def scale_backbone_batched(h, backbone_factors: Tuple[float, ...], backbone_mask: torch.Tensor, versions: Tuple[str, ...]):
+    sample_indices = get_sample_indices(h.shape[0], len(backbone_factors), h.device)
+    factors = torch.tensor(backbone_factors, device=h.device, dtype=h.dtype)[sample_indices].reshape(-1, 1, 1, 1)
+
+    if "2" not in versions:
+        scale = factors
+    else:
+        scale = get_backbone_scale(h, factors, "2")
+        if "1" in versions:
+            is_version_1 = torch.tensor([version == "1" for version in versions], device=h.device)[sample_indices]
+            scale = torch.where(is_version_1.reshape(-1, 1, 1, 1), factors, scale)
 
+    h *= 1 + backbone_mask[sample_indices] * (scale - 1)
 
-def get_backbone_scale(h, backbone_factor):
-    if global_state.instance.version == "1":
+
+@functools.lru_cache(maxsize=16)
+def get_sample_indices(batch_size: int, configs_count: int, device: torch.device) -> torch.Tensor:
+    return torch.arange(batch_size, device=device) % configs_count
+
+
+def get_backbone_scale(h, backbone_factor, version="1"):
+    if version == "1":
         return backbone_factor
 
-    #if global_state.instance.version == "2":
+    #if version == "2":
+    if shared.opts.data.get("freeu_compile_backbone_scale", False):
+        return compiled_backbone_scale_v2(h, backbone_factor)
+
+    return backbone_scale_v2(h, backbone_factor)
+
+
+def backbone_scale_v2(h, backbone_factor):
     features_mean = h.mean(1, keepdim=True)
-    batch_dims = h.shape[0]
-    features_max, _ = torch.max(features_mean.view(batch_dims, -1), dim=-1, keepdim=True)
-    features_min, _ = torch.min(features_mean.view(batch_dims, -1), dim=-1, keepdim=True)
-    hidden_mean = (features_mean - features_min.unsqueeze(2).unsqueeze(3)) / (features_max - features_min).unsqueeze(2).unsqueeze(3)
-    return 1 + (backbone_factor - 1) * hidden_mean
+    features_min, features_max = torch.aminmax(features_mean.flatten(1), dim=-1)
+    features_min = features_min.reshape(-1, 1, 1, 1)
+    features_max = features_max.reshape(-1, 1, 1, 1)
+
+    # 1 + (backbone_factor - 1) * (features_mean - features_min) / (features_max - features_min), without temporaries
+    features_mean -= features_min
+    features_mean *= (backbone_factor - 1) / (features_max - features_min)
+    features_mean += 1
+    return features_mean
+
 
+compiled_backbone_scale_v2_function: Optional[Callable] = None
+def compiled_backbone_scale_v2(h, backbone_factor):
+    global compiled_backbone_scale_v2_function
 
-def filter_skip(x, threshold, scale, scale_high):
-    if scale == 1 and scale_high == 1:
+    if compiled_backbone_scale_v2_function is None:
+        try:
+            compiled_backbone_scale_v2_function = torch.compile(backbone_scale_v2, dynamic=True)
+        except (AttributeError, RuntimeError) as e:
+            print("[sd-webui-freeu]", f"torch.compile is not available, falling back to eager backbone scaling: {e}", file=sys.stderr)
+            compiled_backbone_scale_v2_function = backbone_scale_v2
+
+    try:
+        return compiled_backbone_scale_v2_function(h, backbone_factor)
+    except Exception as e:
+        if compiled_backbone_scale_v2_function is backbone_scale_v2:
+            raise
+
+        print("[sd-webui-freeu]", f"Compiled backbone scaling failed, falling back to eager: {e}", file=sys.stderr)
+        compiled_backbone_scale_v2_function = backbone_scale_v2
+        return backbone_scale_v2(h, backbone_factor)
+
+
+def filter_skip(x, threshold, scale, scale_high, cache: Optional[dict] = None):
+    if is_identity_skip(scale, scale_high):
         return x
 
+    return get_skip_filter_engine(x, threshold, scale, scale_high)(x, threshold, scale, scale_high, cache)
+
+
+def get_skip_filter_engine(x, threshold, scale, scale_high) -> Callable:
+    engine_name = shared.opts.data.get("freeu_skip_filter_engine", "rfft")
+    if engine_name == "auto":
+        return get_fastest_skip_filter_engine(x, threshold, scale, scale_high)
+
+    engine = skip_filter_engines.get(engine_name, filter_skip_rfft)
+    if engine in complex_skip_filter_engines and not is_gpu_complex_supported(x):
+        if shared.opts.data.get("freeu_skip_filter_fallback", "matmul") == "matmul":
+            engine = filter_skip_matmul
+
+    return engine
+
+
+def get_cached(cache: Optional[dict], function: Callable, *args):
+    # the cache of the step factors holds what the step needs, the lru caches of the functions are left to the other stages
+    if cache is None:
+        return function(*args)
+
+    key = function, args
+    result = cache.get(key)
+    if result is None:
+        result = cache[key] = function(*args)
+
+    return result
+
+
+def filter_skip_fft(x, threshold, scale, scale_high, cache: Optional[dict] = None):
     fft_device = x.device
     if not is_gpu_complex_supported(x):
         fft_device = "cpu"
@@ -102,14 +548,8 @@ def filter_skip(x, threshold, scale, scale_high):
     x_freq = torch.fft.fftn(x.to(fft_device, dtype=torch.float32), dim=(-2, -1))
     x_freq = torch.fft.fftshift(x_freq, dim=(-2, -1))
 
-    B, C, H, W = x_freq.shape
-    mask = torch.full((B, C, H, W), float(scale_high), device=fft_device)
-
-    crow, ccol = H // 2, W // 2
-    threshold_row = max(1, math.floor(crow * threshold))
-    threshold_col = max(1, math.floor(ccol * threshold))
-    mask[..., crow - threshold_row:crow + threshold_row, ccol - threshold_col:ccol + threshold_col] = scale
-    x_freq *= mask
+    H, W = x_freq.shape[-2:]
+    x_freq *= get_cached(cache, get_skip_filter_masks, get_skip_filter_mask, x.shape[0], H, W, threshold, scale, scale_high, torch.device(fft_device))
 
     # IFFT
     x_freq = torch.fft.ifftshift(x_freq, dim=(-2, -1))
@@ -118,6 +558,288 @@ def filter_skip(x, threshold, scale, scale_high):
     return x_filtered
 
 
+def filter_skip_rfft(x, threshold, scale, scale_high, cache: Optional[dict] = None):
+    fft_device = x.device
+    if not is_gpu_complex_supported(x):
+        fft_device = "cpu"
+
+    H, W = x.shape[-2:]
+    dtype = get_skip_filter_dtype(x, complex_engine=True)
+    x_freq = torch.fft.rfftn(x.to(fft_device, dtype=dtype), dim=(-2, -1))
+    mask = get_cached(cache, get_skip_filter_masks, get_skip_filter_rfft_mask, x.shape[0], H, W, threshold, scale, scale_high, torch.device(fft_device))
+    # the mask is real, scaling the real and imaginary parts avoids relying on complex half kernels
+    torch.view_as_real(x_freq).mul_(mask.to(dtype).unsqueeze(-1))
+    return torch.fft.irfftn(x_freq, s=(H, W), dim=(-2, -1)).to(device=x.device, dtype=x.dtype)
+
+
+def filter_skip_matmul(x, threshold, scale, scale_high, cache: Optional[dict] = None):
+    # real valued, runs on any device: the low frequency window is applied as separable projections along H and W
+    x_float = x.to(get_skip_filter_dtype(x, complex_engine=False))
+    batch_size = x.shape[0]
+
+    if isinstance(threshold, tuple):
+        sample_thresholds = [threshold[i % len(threshold)] for i in range(batch_size)]
+        x_low = torch.empty_like(x_float)
+        for sample_threshold in set(sample_thresholds):
+            indices = [i for i, t in enumerate(sample_thresholds) if t == sample_threshold]
+            x_low[indices] = low_pass_matmul(x_float[indices], sample_threshold, cache)
+    else:
+        x_low = low_pass_matmul(x_float, threshold, cache)
+
+    scale = get_batch_factor(scale, batch_size, x.device)
+    scale_high = get_batch_factor(scale_high, batch_size, x.device)
+    x_low *= scale - scale_high
+    x_low += x_float * scale_high
+    return x_low.to(dtype=x.dtype)
+
+
+def low_pass_matmul(x, threshold, cache: Optional[dict] = None):
+    rows_real, rows_imag, cols_real, cols_imag = get_cached(cache, get_skip_filter_projections, *x.shape[-2:], threshold, x.device, x.dtype)
+    # real part of the complex separable projection rows @ x @ cols
+    x_low = rows_real @ x @ cols_real
+    x_low -= rows_imag @ x @ cols_imag
+    return x_low
+
+
+def filter_skip_lowrank(x, threshold, scale, scale_high, cache: Optional[dict] = None):
+    # with scale_high == 1, only the low frequency window changes: x + (scale - 1) * low_pass(x)
+    # low_pass is computed from the few frequencies inside the window, at a cost proportional to the window size
+    if not is_lowrank_eligible(*x.shape[-2:], threshold, scale_high):
+        return filter_skip_rfft(x, threshold, scale, scale_high, cache) if is_gpu_complex_supported(x) else filter_skip_matmul(x, threshold, scale, scale_high, cache)
+
+    x_float = x.to(get_skip_filter_dtype(x, complex_engine=False))
+    batch_size = x.shape[0]
+
+    if isinstance(threshold, tuple):
+        sample_thresholds = [threshold[i % len(threshold)] for i in range(batch_size)]
+        x_low = torch.empty_like(x_float)
+        for sample_threshold in set(sample_thresholds):
+            indices = [i for i, t in enumerate(sample_thresholds) if t == sample_threshold]
+            x_low[indices] = low_pass_lowrank(x_float[indices], sample_threshold, cache)
+    else:
+        x_low = low_pass_lowrank(x_float, threshold, cache)
+
+    x_low *= get_batch_factor(scale, batch_size, x.device) - 1
+    x_low += x_float
+    return x_low.to(dtype=x.dtype)
+
+
+def is_lowrank_eligible(height: int, width: int, threshold, scale_high) -> bool:
+    # whether filter_skip_lowrank takes its fast path instead of falling back to rfft or matmul
+    thresholds = threshold if isinstance(threshold, tuple) else (threshold,)
+    scales_high = scale_high if isinstance(scale_high, tuple) else (scale_high,)
+    return all(s == 1 for s in scales_high) and all(is_lowrank_window(height, width, t) for t in thresholds)
+
+
+def is_lowrank_window(height: int, width: int, threshold: float) -> bool:
+    # the factors have 4 columns per frequency of window half-width.
+    # once the half-width passes an eighth of the axis, the factors are wider than half the axis and the dense projections are cheaper
+    return all(8 * get_window_half_width(n, threshold) < n for n in (height, width))
+
+
+def low_pass_lowrank(x, threshold, cache: Optional[dict] = None):
+    rows, rows_scaled, cols, cols_scaled = get_cached(cache, get_skip_filter_lowrank_factors, *x.shape[-2:], threshold, x.device, x.dtype)
+    k_rows, k_cols = rows.shape[-1] // 2, cols.shape[-1] // 2
+
+    # the real and imaginary parts of the separable projection share the same cos/sin factors,
+    # so the real part of the result only needs one block matrix of window coefficients
+    z = rows.T @ x @ cols
+    a = z[..., :k_rows, :k_cols] - z[..., k_rows:, k_cols:]
+    b = z[..., :k_rows, k_cols:] + z[..., k_rows:, :k_cols]
+    m = torch.cat([torch.cat([a, b], dim=-1), torch.cat([b, -a], dim=-1)], dim=-2)
+    return rows_scaled @ m @ cols_scaled.T
+
+
+skip_filter_precisions = ["float32", "reduced"]
+
+
+def get_skip_filter_dtype(x, complex_engine: bool) -> torch.dtype:
+    """
+    dtype the skip filter computes in. "reduced" keeps float16 and bfloat16 inputs in their own dtype where the engine supports it.
+    """
+    if shared.opts.data.get("freeu_skip_filter_precision", "float32") != "reduced" or x.dtype not in (torch.float16, torch.bfloat16):
+        return torch.float32
+
+    if not complex_engine:
+        return x.dtype
+
+    # cuFFT only runs half precision transforms on power of two sizes, and there are no bfloat16 transforms
+    H, W = x.shape[-2:]
+    if x.dtype == torch.float16 and x.device.type == "cuda" and is_power_of_two(H) and is_power_of_two(W) and is_fft_supported(x.device, torch.float16):
+        return torch.float16
+
+    return torch.float32
+
+
+def is_power_of_two(n: int) -> bool:
+    return n > 0 and n & (n - 1) == 0
+
+
+def get_batch_factor(factor, batch_size, device):
+    if not isinstance(factor, tuple):
+        return factor
+
+    factors = torch.tensor(factor, device=device)
+    return factors[get_sample_indices(batch_size, len(factor), device)].reshape(-1, 1, 1, 1)
+
+
+skip_filter_engines = {
+    "rfft": filter_skip_rfft,
+    "fft": filter_skip_fft,
+    "matmul": filter_skip_matmul,
+    "lowrank": filter_skip_lowrank,
+}
+complex_skip_filter_engines = {filter_skip_fft, filter_skip_rfft}
+
+
+fastest_skip_filter_engines: Dict[Tuple[Tuple[int, ...], torch.device, torch.dtype, str, bool], Callable] = {}
+
+
+def get_fastest_skip_filter_engine(x, threshold, scale, scale_high) -> Callable:
+    precision = shared.opts.data.get("freeu_skip_filter_precision", "float32")
+    # lowrank is only fast when its fast path applies, both cases are benchmarked separately
+    lowrank_eligible = is_lowrank_eligible(*x.shape[-2:], threshold, scale_high)
+    key = tuple(x.shape), x.device, x.dtype, precision, lowrank_eligible
+    engine = fastest_skip_filter_engines.get(key)
+    if engine is None:
+        engine = fastest_skip_filter_engines[key] = load_or_benchmark_skip_filter_engine(x, threshold, scale, scale_high, precision, lowrank_eligible)
+
+    return engine
+
+
+def load_or_benchmark_skip_filter_engine(x, threshold, scale, scale_high, precision: str, lowrank_eligible: bool) -> Callable:
+    # benchmarks from previous runs on the same device are saved to disk, see capabilities.py
+    capability_key = f"{'x'.join(map(str, x.shape))} {x.dtype} {precision} {'lowrank' if lowrank_eligible else 'dense'}"
+    engine_name = capabilities.get_fastest_engine(x.device, capability_key)
+    if engine_name in skip_filter_engines:
+        return skip_filter_engines[engine_name]
+
+    engine = benchmark_skip_filter_engines(x, threshold, scale, scale_high)
+    engine_name = next(name for name, e in skip_filter_engines.items() if e is engine)
+    capabilities.set_fastest_engine(x.device, capability_key, engine_name)
+    return engine
+
+
+def benchmark_skip_filter_engines(x, threshold, scale, scale_high, repeat: int = 3) -> Callable:
+    engines = list(skip_filter_engines.values())
+    if not is_gpu_complex_supported(x):
+        engines = [engine for engine in engines if engine not in complex_skip_filter_engines]
+    if not is_lowrank_eligible(*x.shape[-2:], threshold, scale_high):
+        # lowrank would only time its rfft or matmul fallback
+        engines.remove(filter_skip_lowrank)
+
+    timings = {}
+    for engine in engines:
+        engine(x, threshold, scale, scale_high)  # warm up caches and kernels
+        profiling.synchronize(x.device)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            engine(x, threshold, scale, scale_high)
+        profiling.synchronize(x.device)
+        timings[engine] = time.perf_counter() - start
+
+    return min(timings, key=timings.get)
+
+
+def is_identity_skip(scale, scale_high) -> bool:
+    if isinstance(scale, tuple):
+        return all(s == 1 for s in scale) and all(s == 1 for s in scale_high)
+
+    return scale == 1 and scale_high == 1
+
+
+def get_skip_filter_masks(mask_function, batch_size, height, width, threshold, scale, scale_high, device):
+    if not isinstance(scale, tuple):
+        return mask_function(height, width, threshold, scale, scale_high, device)
+
+    return get_stacked_skip_filter_masks(mask_function, batch_size, height, width, threshold, scale, scale_high, device)
+
+
+@functools.lru_cache(maxsize=16)
+def get_stacked_skip_filter_masks(mask_function, batch_size, height, width, thresholds, scales, scales_high, device):
+    masks = torch.cat([
+        mask_function(height, width, threshold, scale, scale_high, device)
+        for threshold, scale, scale_high in zip(thresholds, scales, scales_high)
+    ])
+    return masks[get_sample_indices(batch_size, len(masks), device)]
+
+
+@functools.lru_cache(maxsize=64)
+def get_skip_filter_mask(height: int, width: int, threshold: float, scale: float, scale_high: float, device: torch.device) -> torch.Tensor:
+    mask = torch.full((1, 1, height, width), float(scale_high), device=device)
+
+    crow, ccol = height // 2, width // 2
+    threshold_row = max(1, math.floor(crow * threshold))
+    threshold_col = max(1, math.floor(ccol * threshold))
+    mask[..., crow - threshold_row:crow + threshold_row, ccol - threshold_col:ccol + threshold_col] = scale
+    return mask
+
+
+@functools.lru_cache(maxsize=64)
+def get_skip_filter_rfft_mask(height: int, width: int, threshold: float, scale: float, scale_high: float, device: torch.device) -> torch.Tensor:
+    mask = torch.fft.ifftshift(get_skip_filter_mask(height, width, threshold, scale, scale_high, device), dim=(-2, -1))
+    # the fft path keeps the real part of the result, which is the same as filtering with the hermitian part of the mask
+    # irfftn assumes a hermitian spectrum, so symmetrize the mask before dropping the redundant half
+    mask = (mask + mask.flip(-2, -1).roll((1, 1), dims=(-2, -1))) / 2
+    return mask[..., :width // 2 + 1].contiguous()
+
+
+@functools.lru_cache(maxsize=32)
+def get_skip_filter_projections(height: int, width: int, threshold: float, device: torch.device, dtype: torch.dtype = torch.float32) -> Tuple[torch.Tensor, ...]:
+    rows = get_low_pass_projection(height, threshold)
+    cols = get_low_pass_projection(width, threshold).T
+    return tuple(
+        m.to(device=device, dtype=dtype).contiguous()
+        for m in (rows.real, rows.imag, cols.real, cols.imag)
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def get_skip_filter_lowrank_factors(height: int, width: int, threshold: float, device: torch.device, dtype: torch.dtype) -> Tuple[torch.Tensor, ...]:
+    rows = get_low_pass_factor(height, threshold)
+    cols = get_low_pass_factor(width, threshold)
+    return tuple(
+        m.to(device=device, dtype=dtype).contiguous()
+        for m in (rows, rows / height, cols, cols / width)
+    )
+
+
+def get_low_pass_factor(n: int, threshold: float) -> torch.Tensor:
+    # [cos, sin] of the frequencies inside the window, so that the projection of get_low_pass_projection is
+    # (factor @ factor.T + 1j * factor @ J @ factor.T) / n with J the quarter turn of the cos and sin halves
+    threshold_n = get_window_half_width(n, threshold)
+    frequencies = torch.arange(-threshold_n, threshold_n, dtype=torch.float64)
+    angles = 2 * math.pi * torch.arange(n, dtype=torch.float64)[:, None] * frequencies[None, :] / n
+    return torch.cat([angles.cos(), angles.sin()], dim=-1)
+
+
+def get_window_half_width(n: int, threshold: float) -> int:
+    return max(1, math.floor(n // 2 * threshold))
+
+
+def get_low_pass_projection(n: int, threshold: float) -> torch.Tensor:
+    # same window as get_skip_filter_mask along one axis, moved back to unshifted frequency order
+    center = n // 2
+    threshold_n = get_window_half_width(n, threshold)
+    window = torch.zeros(n, dtype=torch.float64)
+    window[center - threshold_n:center + threshold_n] = 1
+    window = torch.fft.ifftshift(window)
+
+    # ifft(window * fft(x)) == projection @ x
+    return torch.fft.ifft(window[:, None] * torch.fft.fft(torch.eye(n, dtype=torch.float64), dim=0), dim=0)
+
+
+def clear_caches():
+    get_skip_filter_mask.cache_clear()
+    get_skip_filter_rfft_mask.cache_clear()
+    get_stacked_skip_filter_masks.cache_clear()
+    get_sample_indices.cache_clear()
+    get_skip_filter_projections.cache_clear()
+    get_skip_filter_lowrank_factors.cache_clear()
+    fastest_skip_filter_engines.clear()
+    stage_layouts.clear()
+
+
 def ratio_to_region(width: float, offset: float, n: int) -> Tuple[int, int, bool]:
     if width < 0:
         offset += width
@@ -140,20 +862,99 @@ def ratio_to_region(width: float, offset: float, n: int) -> Tuple[int, int, bool
     return round(start), round(end), inverted
 
 
-def get_schedule_ratio():
-    start_step = to_denoising_step(global_state.instance.start_ratio)
-    stop_step = to_denoising_step(global_state.instance.stop_ratio)
+def region_to_slices(begin: int, end: int, inverted: bool, n: int) -> List[slice]:
+    if inverted:
+        return [slice(0, begin), slice(end + 1, n)]
+
+    return [slice(begin, end + 1)]
+
+
+class Schedule:
+    """
+    Ratio of the FreeU effect at each step of one State, tabulated once for a number of sampling steps.
+    """
+
+    def __init__(self, state: global_state.State, steps: int):
+        self.state = state
+        self.steps = steps
+        self.ratios = [
+            get_schedule_ratio(state, step, steps) if state.enable else 0.0
+            for step in range(steps + 1)
+        ]
+
+    def get_ratio(self, step: int) -> float:
+        if 0 <= step < len(self.ratios):
+            return self.ratios[step]
+
+        if not self.state.enable:
+            return 0.0
+
+        return get_schedule_ratio(self.state, step, self.steps)
+
+
+def get_schedule_ratio(state: global_state.State, step: int, steps: int) -> float:
+    if state.schedule_curve == "keyframes":
+        return interpolate_keyframes(state.schedule_keyframes or [[0.0, 1.0]], step, steps)
+
+    start_step = to_denoising_step(state.start_ratio, steps)
+    stop_step = to_denoising_step(state.stop_ratio, steps)
 
     if start_step == stop_step:
         smooth_schedule_ratio = 0.0
-    elif global_state.current_sampling_step < start_step:
-        smooth_schedule_ratio = min(1.0, max(0.0, global_state.current_sampling_step / start_step))
+    elif step < start_step:
+        smooth_schedule_ratio = min(1.0, max(0.0, step / start_step))
     else:
-        smooth_schedule_ratio = min(1.0, max(0.0, 1 + (global_state.current_sampling_step - start_step) / (start_step - stop_step)))
+        smooth_schedule_ratio = min(1.0, max(0.0, 1 + (step - start_step) / (start_step - stop_step)))
+
+    curve = schedule_curves.get(state.schedule_curve, linear_curve)
+    flat_schedule_ratio = 1.0 if start_step <= step < stop_step else 0.0
+
+    return lerp(flat_schedule_ratio, curve(smooth_schedule_ratio), state.transition_smoothness)
+
+
+def interpolate_keyframes(keyframes: List[List[Union[float, int]]], step: int, steps: int) -> float:
+    """
+    Linear interpolation between [position, value] keyframes, constant before the first and after the last.
+    Float positions are ratios of the sampling steps, integer positions are step numbers.
+    """
+    keyframes = sorted((to_denoising_position(position, steps), float(value)) for position, value in keyframes)
+    positions = [position for position, _ in keyframes]
+    index = bisect.bisect_right(positions, step)
+    if index == 0:
+        return keyframes[0][1]
+    if index == len(keyframes):
+        return keyframes[-1][1]
+
+    (begin, begin_value), (end, end_value) = keyframes[index - 1], keyframes[index]
+    return lerp(begin_value, end_value, (step - begin) / (end - begin))
+
+
+def to_denoising_position(number: Union[float, int], steps: int) -> float:
+    if isinstance(number, float):
+        return number * steps
+
+    return number
+
+
+def linear_curve(ratio: float) -> float:
+    return ratio
+
 
-    flat_schedule_ratio = 1.0 if start_step <= global_state.current_sampling_step < stop_step else 0.0
+def cosine_curve(ratio: float) -> float:
+    return (1 - math.cos(math.pi * ratio)) / 2
 
-    return lerp(flat_schedule_ratio, smooth_schedule_ratio, global_state.instance.transition_smoothness)
+
+EXPONENTIAL_CURVE_RATE = 4.0
+def exponential_curve(ratio: float) -> float:
+    return math.expm1(EXPONENTIAL_CURVE_RATE * ratio) / math.expm1(EXPONENTIAL_CURVE_RATE)
+
+
+# shapes of the smooth transitions around start and stop. "keyframes" replaces the whole schedule instead
+schedule_curves = {
+    "linear": linear_curve,
+    "cosine": cosine_curve,
+    "exponential": exponential_curve,
+}
 
 
 def to_denoising_step(number: Union[float, int], steps=None) -> int:
@@ -170,16 +971,34 @@ def lerp(a, b, r):
     return (1-r)*a + r*b
 
 
-gpu_complex_support: Optional[bool] = None
-def is_gpu_complex_supported(x):
-    global gpu_complex_support
+# (device, dtype) -> whether ffts work there. successful probes are saved to disk, see capabilities.py
+fft_support: Dict[Tuple[torch.device, torch.dtype], bool] = {}
 
+
+def is_gpu_complex_supported(x):
     if x.is_cpu:
         return True
 
-    if gpu_complex_support is not None:
-        return gpu_complex_support
+    return is_fft_supported(x.device, torch.float32)
+
 
+def is_fft_supported(device: torch.device, dtype: torch.dtype) -> bool:
+    key = device, dtype
+    supported = fft_support.get(key)
+    if supported is None:
+        # a failed probe can be transient (out of memory, driver state), only successes are kept across restarts
+        supported = capabilities.get_fft_support(device, dtype) or probe_fft_support(device, dtype)
+        if supported is None:
+            # inconclusive, probe again on the next call
+            return False
+        if supported:
+            capabilities.set_fft_support(device, dtype, True)
+        fft_support[key] = supported
+
+    return supported
+
+
+def probe_fft_support(device: torch.device, dtype: torch.dtype) -> Optional[bool]:
     # catch known cases in advance
     mps_available = hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
     try:
@@ -189,12 +1008,18 @@ def is_gpu_complex_supported(x):
     else:
         dml_available = torch_directml.is_available()
 
-    gpu_complex_support = not (mps_available or dml_available)
-    if gpu_complex_support:
-        # try filter_skip fft to make sure it is viable on the gpu
-        try:
-            torch.fft.fftn(x.float(), dim=(-2, -1))
-        except RuntimeError:
-            gpu_complex_support = False
+    if device.type != "cpu" and (mps_available or dml_available):
+        return False
+
+    # try the filter_skip transforms to make sure they are viable on the device
+    try:
+        x = torch.randn(1, 1, 16, 16, device=device).to(dtype)
+        torch.fft.irfftn(torch.fft.rfftn(x, dim=(-2, -1)), s=x.shape[-2:], dim=(-2, -1))
+        torch.fft.ifftn(torch.fft.fftn(x, dim=(-2, -1)), dim=(-2, -1))
+    except RuntimeError as e:
+        if "out of memory" in str(e):
+            return None
+
+        return False
 
-    return gpu_complex_support
+    return True
@@ -1,8 +1,13 @@
+import copy
+import functools
+import hashlib
+import inspect
 import sys
+import threading
 from types import ModuleType
-from typing import Optional
-from modules import scripts
-from lib_free_u import global_state
+from typing import Dict, Optional
+from modules import processing, scripts, shared
+from lib_free_u import global_state, sweep_cache, unet
 
 
 def patch():
@@ -17,6 +22,7 @@ def patch():
         xyz_module.AxisOption("[FreeU] Start At Step", int_or_float, apply_global_state("start_ratio")),
         xyz_module.AxisOption("[FreeU] Stop At Step", int_or_float, apply_global_state("stop_ratio")),
         xyz_module.AxisOption("[FreeU] Transition Smoothness", int_or_float, apply_global_state("transition_smoothness")),
+        xyz_module.AxisOption("[FreeU] Schedule Curve", str, apply_global_state("schedule_curve"), choices=choices_schedule_curve),
         *[
             opt
             for index in range(global_state.STAGES_COUNT)
@@ -31,16 +37,192 @@ def patch():
         ]
     ])
 
+    if hasattr(xyz_module, "process_images"):
+        xyz_module.process_images = functools.partial(process_images_hijack, original_function=xyz_module.process_images)
+
+    script_class = getattr(xyz_module, "Script", None)
+    if script_class is not None and hasattr(script_class, "run"):
+        script_class.run = functools.partialmethod(xyz_run_hijack, original_function=script_class.run)
+
 
 def apply_global_state(k, key_map=None):
-    def callback(_p, v, _vs):
+    def callback(_p, v, vs):
         if key_map is not None:
             v = key_map[v]
-        global_state.xyz_attrs[k] = v
+            vs = [key_map[value] for value in vs]
+        generation_state = global_state.get_generation_state()
+        generation_state.xyz_attrs[k] = v
+        generation_state.xyz_axis_values[k] = vs
 
     return callback
 
 
+class BatchedCells:
+    """
+    Samples of the batched FreeU axes of the current grid, by cell fingerprint and axis value.
+    Cells that only differ by the value of a FreeU axis read their sample from here, in any loop order of the grid.
+    Each sample is released when its cell reads it, and everything is released when the grid ends.
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, dict] = {}
+        self.lock = threading.Lock()
+
+    def pop(self, fingerprint: str, value):
+        with self.lock:
+            samples = self.samples.get(fingerprint, {})
+            sample = samples.pop(value, None)
+            if not samples:
+                self.samples.pop(fingerprint, None)
+
+        return sample
+
+    def put(self, fingerprint: str, samples: dict):
+        with self.lock:
+            self.samples.setdefault(fingerprint, {}).update(samples)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+
+batched_cells = BatchedCells()
+
+
+def xyz_run_hijack(self, *args, original_function, **kwargs):
+    batched_cells.clear()
+    try:
+        return original_function(self, *args, **kwargs)
+    finally:
+        batched_cells.clear()
+
+
+def process_images_hijack(p, *args, original_function, **kwargs):
+    generation_state = global_state.get_generation_state()
+    axis_key = get_batched_axis_key(generation_state)
+    if axis_key is None or p.batch_size != 1 or p.n_iter != 1 or not can_batch_infotexts():
+        generation_state.xyz_axis_values.clear()
+        return original_function(p, *args, **kwargs)
+
+    values = generation_state.xyz_axis_values[axis_key]
+    value = generation_state.xyz_attrs[axis_key]
+    other_xyz_attrs = {k: v for k, v in generation_state.xyz_attrs.items() if k != axis_key}
+    fingerprint = get_cell_fingerprint(p, axis_key, other_xyz_attrs)
+    generation_state.xyz_axis_values.clear()
+
+    sample = batched_cells.pop(fingerprint, value)
+    if sample is None:
+        # the values are sampled in chunks, so that long axes do not run out of memory in a single batch
+        max_batch_size = max(1, int(shared.opts.data.get("freeu_xyz_batch_max_size", 8)))
+        chunk_begin = values.index(value) // max_batch_size * max_batch_size
+        chunk_values = list(dict.fromkeys(values[chunk_begin:chunk_begin + max_batch_size]))
+        generation_state.xyz_batch_attrs = [{**other_xyz_attrs, axis_key: v} for v in chunk_values]
+        p.batch_size = len(chunk_values)
+        try:
+            processed = original_function(p, *args, **kwargs)
+        finally:
+            generation_state.xyz_batch_attrs = None
+
+        batched_cells.put(fingerprint, {v: get_processed_sample(processed, i) for i, v in enumerate(chunk_values)})
+        sample = batched_cells.pop(fingerprint, value)
+
+    # cells served from the batch never reach process, which would otherwise consume the attrs
+    generation_state.xyz_attrs.clear()
+    return sample
+
+
+def get_batched_axis_key(generation_state: global_state.GenerationState) -> Optional[str]:
+    if not shared.opts.data.get("freeu_xyz_batch_sweep", False):
+        return None
+
+    for k, values in generation_state.xyz_axis_values.items():
+        if len(values) > 1 and k in generation_state.xyz_attrs:
+            return k
+
+    return None
+
+
+# fields of p that a non FreeU axis or script can change, other fields are either derived from these or filled during generation
+CELL_FIELDS = [
+    "prompt",
+    "negative_prompt",
+    "styles",
+    "seed",
+    "subseed",
+    "subseed_strength",
+    "seed_resize_from_h",
+    "seed_resize_from_w",
+    "sampler_name",
+    "scheduler",
+    "steps",
+    "cfg_scale",
+    "width",
+    "height",
+    "denoising_strength",
+    "restore_faces",
+    "tiling",
+    "s_churn",
+    "s_tmin",
+    "s_tmax",
+    "s_noise",
+    "s_min_uncond",
+    "enable_hr",
+    "hr_scale",
+    "hr_upscaler",
+    "hr_second_pass_steps",
+    "hr_resize_x",
+    "hr_resize_y",
+    "hr_checkpoint_name",
+    "hr_sampler_name",
+    "hr_scheduler",
+    "hr_prompt",
+    "hr_negative_prompt",
+    "refiner_checkpoint",
+    "refiner_switch_at",
+    "override_settings",
+]
+
+
+def get_cell_fingerprint(p, axis_key: str, other_xyz_attrs: dict) -> str:
+    # everything a non FreeU axis could change: CELL_FIELDS, the checkpoint, extra networks and script args
+    fields = {k: getattr(p, k, None) for k in CELL_FIELDS}
+    digest = hashlib.sha256()
+    sweep_cache.update_fingerprint(digest, [axis_key, other_xyz_attrs, fields])
+    digest.update(sweep_cache.get_fingerprint(p).encode())
+    return digest.hexdigest()
+
+
+def can_batch_infotexts() -> bool:
+    # without per image infotext values, every image of the batch would be saved with the params of the first cell
+    return is_per_image_infotext_supported() or not shared.opts.data.get("enable_pnginfo", True)
+
+
+@functools.lru_cache(maxsize=None)
+def is_per_image_infotext_supported() -> bool:
+    # webui >= 1.8.0 calls the callables of extra_generation_params once per image
+    try:
+        source = inspect.getsource(getattr(processing, "create_infotext", None))
+    except (OSError, TypeError):
+        return False
+
+    return "callable(value)" in source
+
+
+def get_processed_sample(processed, index: int):
+    # xyz_grid reads the first image of each cell
+    sample = copy.copy(processed)
+    image_index = processed.index_of_first_image + index
+    sample.images = [processed.images[image_index]]
+    sample.infotexts = [processed.infotexts[image_index]]
+    sample.index_of_first_image = 0
+    for attribute in ("all_prompts", "all_negative_prompts", "all_seeds", "all_subseeds"):
+        values = getattr(processed, attribute, None)
+        if values:
+            setattr(sample, attribute, [values[index]])
+
+    return sample
+
+
 def str_to_bool(string):
     string = str(string)
     if string in ["None", ""]:
@@ -68,6 +250,10 @@ def choices_version():
     return list(global_state.all_versions.keys())
 
 
+def choices_schedule_curve():
+    return [*unet.schedule_curves.keys(), "keyframes"]
+
+
 def choices_preset():
     presets = list(global_state.all_presets.keys())
     presets.insert(0, "UI Settings")
@@ -1,7 +1,8 @@
 import json
+from typing import List, Optional, Tuple
 import gradio as gr
 from modules import scripts, script_callbacks, processing, shared
-from lib_free_u import global_state, unet, xyz_grid
+from lib_free_u import global_state, profiling, sampling_steps, sweep_cache, unet, xyz_grid
 
 
 txt2img_steps_component = None
@@ -186,11 +187,7 @@ class FreeUScript(scripts.Script):
                 gr.Slider.update(value=preset.start_ratio),
                 gr.Slider.update(value=preset.stop_ratio),
                 gr.Slider.update(value=preset.transition_smoothness),
-                *[
-                    gr.update(value=v)
-                    for stage_info in preset.stage_infos
-                    for v in stage_info.to_dict(include_default=True).values()
-                ],
+                *[gr.update(value=v) for v in get_stage_infos_slider_values(preset.stage_infos)],
             )
 
         apply_preset.click(
@@ -206,7 +203,6 @@ class FreeUScript(scripts.Script):
                 stop_ratio=stop_ratio,
                 transition_smoothness=transition_smoothness,
             )
-            global_state.save_presets()
 
             return (
                 gr.Dropdown.update(choices=list(global_state.all_presets.keys())),
@@ -241,7 +237,6 @@ class FreeUScript(scripts.Script):
         def on_delete_click(preset_name):
             preset_name_index = list(global_state.all_presets.keys()).index(preset_name)
             del global_state.all_presets[preset_name]
-            global_state.save_presets()
 
             preset_name_index = min(len(global_state.all_presets) - 1, preset_name_index)
             preset_names = list(global_state.all_presets.keys())
@@ -335,11 +330,7 @@ class FreeUScript(scripts.Script):
         return (
             gr.update(value=""),
             gr.update(value=shared.opts.data.get("freeu_png_info_auto_enable", True)),
-            *(
-                gr.update(value=v)
-                for stage_info in stage_infos
-                for v in stage_info.to_dict(include_default=True).values()
-            )
+            *(gr.update(value=v) for v in get_stage_infos_slider_values(stage_infos))
         )
 
     def on_version_infotext_update(self, infotext):
@@ -356,11 +347,22 @@ class FreeUScript(scripts.Script):
         p: processing.StableDiffusionProcessing,
         *args
     ):
-        if isinstance(args[0], dict):
-            global_state.instance = global_state.State(**args[0])
+        generation_state = global_state.get_generation_state()
+        batch_states = []
+        hires_state_dicts = []
+        if isinstance(args[0], list):
+            if not args[0]:
+                raise ValueError("Expected at least one FreeU settings dict in the per-sample list, got an empty list")
+            state_dicts, hires_state_dicts = zip(*map(split_hires_state_dict, args[0]))
+            batch_states = [global_state.state_cache.get_state(state_dict) for state_dict in state_dicts]
+            generation_state.instance = batch_states[0]
+        elif isinstance(args[0], dict):
+            state_dict, hires_state_dict = split_hires_state_dict(args[0])
+            hires_state_dicts = [hires_state_dict]
+            generation_state.instance = global_state.state_cache.get_state(state_dict)
         elif isinstance(args[0], bool):
             stage_infos_begin = global_state.STATE_ARGS_LEN - 1
-            global_state.instance = global_state.State(
+            generation_state.instance = global_state.State(
                 args[0],
                 *[float(n) for n in args[1:stage_infos_begin-1]],
                 args[stage_infos_begin-1],
@@ -369,31 +371,232 @@ class FreeUScript(scripts.Script):
         else:
             raise TypeError(f"Unrecognized args sequence starting with type {type(args[0])}")
 
-        global_state.apply_xyz()
-        global_state.xyz_attrs.clear()
-        if not global_state.instance.enable:
+        if generation_state.xyz_batch_attrs is not None:
+            # one sample per value of a FreeU xyz axis, see xyz_grid.process_images_hijack
+            samples_xyz_attrs = generation_state.xyz_batch_attrs
+            batch_states = [
+                global_state.apply_xyz_attrs(generation_state.instance, xyz_attrs)
+                for xyz_attrs in samples_xyz_attrs
+            ]
+            generation_state.instance = batch_states[0]
+            generation_state.xyz_batch_attrs = None
+            p.all_seeds = [p.all_seeds[0]] * len(p.all_seeds)
+            p.all_subseeds = [p.all_subseeds[0]] * len(p.all_subseeds)
+        else:
+            samples_xyz_attrs = [dict(generation_state.xyz_attrs)]
+            if generation_state.xyz_attrs:
+                batch_states = [global_state.apply_xyz_attrs(state, generation_state.xyz_attrs) for state in batch_states]
+            generation_state.apply_xyz()
+        generation_state.xyz_attrs.clear()
+        states = [generation_state.instance, *batch_states[1:]]
+        if len(hires_state_dicts) == 1:
+            # a single hires dict applies to every sample
+            hires_state_dicts = hires_state_dicts * len(states)
+        hires_state_dicts = [*hires_state_dicts, *[None] * (len(states) - len(hires_state_dicts))]
+        has_hires_states = any(hires_state_dict is not None for hires_state_dict in hires_state_dicts)
+        hires_states = [
+            get_hires_state(hires_state_dict, samples_xyz_attrs[i % len(samples_xyz_attrs)]) if hires_state_dict is not None else state
+            for i, (state, hires_state_dict) in enumerate(zip(states, hires_state_dicts))
+        ]
+        states = expand_batch_states(states, p.batch_size)
+        hires_states = expand_batch_states(hires_states, p.batch_size)
+
+        diffusion_model = unet.get_diffusion_model()
+        layout = unet.get_stage_layout(diffusion_model)
+        if shared.opts.data.get("freeu_sweep_cache", False) and diffusion_model is not None:
+            sweep_cache.install(diffusion_model)
+            generation_state.sweep_fingerprint = sweep_cache.get_fingerprint(p, (self.args_from, self.args_to))
+        else:
+            sweep_cache.uninstall_all()
+            sweep_cache.cache.clear()
+            generation_state.sweep_fingerprint = None
+
+        generation_state.base_plan = unet.create_plan(states, p.steps, layout)
+        generation_state.hires_plan = unet.create_plan(hires_states, None, layout) if has_hires_states else generation_state.base_plan
+        generation_state.plan = generation_state.base_plan
+        if generation_state.base_plan is None and generation_state.hires_plan is None:
+            release_hooks(generation_state)
             return
 
-        last_d = False
-        p.extra_generation_params["FreeU Stages"] = json.dumps(list(reversed([
+        update_hooks(generation_state, diffusion_model)
+
+        profiling_mode = shared.opts.data.get("freeu_profiling", "off")
+        generation_state.profiler = profiling.Profiler(profiling_mode) if profiling_mode != "off" else None
+
+        infotexts = [
+            global_state.state_cache.get_infotext(state, get_infotext_params) if state.enable else {}
+            for state in states
+        ]
+        if has_hires_states:
+            infotexts = [
+                {**infotext, **global_state.state_cache.get_infotext(hires_state, get_hires_infotext_params)}
+                for infotext, hires_state in zip(infotexts, hires_states)
+            ]
+        p.extra_generation_params.update(get_batch_infotext_params(infotexts))
+
+    def process_batch(self, p, *args, **kwargs):
+        generation_state = global_state.get_generation_state()
+        generation_state.plan = generation_state.base_plan
+        reset_sampling_step(generation_state)
+        update_hooks(generation_state, unet.get_diffusion_model())
+
+    def before_hr(self, p, *args):
+        generation_state = global_state.get_generation_state()
+        generation_state.plan = generation_state.hires_plan
+        reset_sampling_step(generation_state)
+        update_hooks(generation_state, unet.get_diffusion_model())
+
+    def postprocess_batch(self, p, *args, **kwargs):
+        profiler = global_state.get_generation_state().profiler
+        if profiler is not None:
+            p.extra_generation_params["FreeU Profile"] = profiler.format_summary()
+
+    def postprocess(self, p, processed, *args):
+        generation_state = global_state.get_generation_state()
+        if generation_state.profiler is not None:
+            summary = generation_state.profiler.summary()
+            profiling.recent_profiles.append(summary)
+            print("[sd-webui-freeu]", "Profile:", json.dumps(summary))
+            generation_state.profiler = None
+
+        generation_state.plan = None
+        generation_state.base_plan = None
+        generation_state.hires_plan = None
+        generation_state.sweep_fingerprint = None
+        release_hooks(generation_state)
+
+
+def get_stage_infos_slider_values(stage_infos: List[global_state.StageInfo]) -> list:
+    # the sliders cannot hold keyframes, show the first value instead
+    return [
+        v[0][1] if isinstance(v, list) else v
+        for stage_info in stage_infos
+        for v in stage_info.to_dict(include_default=True).values()
+    ]
+
+
+def get_infotext_params(instance: global_state.State) -> dict:
+    last_d = False
+    return {
+        "FreeU Stages": json.dumps(list(reversed([
             stage_info.to_dict()
-            for stage_info in reversed(global_state.instance.stage_infos)
+            for stage_info in reversed(instance.stage_infos)
             # strip all empty dicts
             if last_d or stage_info.to_dict() and (last_d := True)
-        ])))
-        p.extra_generation_params["FreeU Schedule"] = ", ".join([
-            str(global_state.instance.start_ratio),
-            str(global_state.instance.stop_ratio),
-            str(global_state.instance.transition_smoothness),
-        ])
-        p.extra_generation_params["FreeU Version"] = global_state.instance.version
+        ]))),
+        "FreeU Schedule": ", ".join([
+            str(instance.start_ratio),
+            str(instance.stop_ratio),
+            str(instance.transition_smoothness),
+            *([instance.schedule_curve] if instance.schedule_curve != "linear" else []),
+            *([json.dumps(instance.schedule_keyframes)] if instance.schedule_keyframes is not None else []),
+        ]),
+        "FreeU Version": instance.version,
+    }
 
-    def process_batch(self, p, *args, **kwargs):
-        global_state.current_sampling_step = 0
+
+def get_hires_infotext_params(hires_state: global_state.State) -> dict:
+    return {
+        "FreeU Hires": json.dumps({
+            "enable": hires_state.enable,
+            **hires_state.to_dict(),
+        }),
+    }
+
+
+def get_batch_infotext_params(infotexts: List[dict]) -> dict:
+    if all(infotext == infotexts[0] for infotext in infotexts) or not xyz_grid.is_per_image_infotext_supported():
+        return infotexts[0]
+
+    # image i of the batch used the config i % len(infotexts), missing keys are left out of its infotext
+    keys = list(dict.fromkeys(k for infotext in infotexts for k in infotext))
+    return {k: get_per_image_infotext_value([infotext.get(k) for infotext in infotexts]) for k in keys}
+
+
+def get_per_image_infotext_value(values: list):
+    def value(position_in_batch=0, **_kwargs):
+        return values[position_in_batch % len(values)]
+
+    return value
+
+
+def expand_batch_states(states: List[global_state.State], batch_size: int) -> List[global_state.State]:
+    # the unet batch is [cond_0..cond_{B-1}, uncond_0..uncond_{B-1}] and the plan gives element i the config i % len(states)
+    # both halves of a sample only agree when the config count divides the batch size, so repeat the configs up to the batch size
+    if batch_size % len(states) == 0:
+        return states
+
+    return [states[i % len(states)] for i in range(batch_size)]
+
+
+def split_hires_state_dict(state_dict: dict) -> Tuple[dict, Optional[dict]]:
+    state_dict = dict(state_dict)
+    hires_state_dict = state_dict.pop("hires", None)
+    return state_dict, hires_state_dict
+
+
+def get_hires_state(hires_state_dict: dict, xyz_attrs: dict) -> global_state.State:
+    # xyz axes change both passes
+    hires_state = global_state.state_cache.get_state(hires_state_dict)
+    if xyz_attrs:
+        hires_state = global_state.apply_xyz_attrs(hires_state, xyz_attrs)
+
+    return hires_state
+
+
+def reset_sampling_step(generation_state: global_state.GenerationState):
+    generation_state.current_sampling_step = 0
+    generation_state.unet_call_index = 0
+    generation_state.sampling_steps = None
+    generation_state.sigma_steps = None
+
+
+def update_hooks(generation_state: global_state.GenerationState, diffusion_model):
+    # the refiner and the hires checkpoint swap the unet during a generation, the hooks and the plans follow it
+    if generation_state.hooked_model is diffusion_model:
+        return
+
+    release_hooks(generation_state)
+    if generation_state.base_plan is None and generation_state.hires_plan is None:
+        return
+
+    layout = unet.get_stage_layout(diffusion_model)
+    plan, base_plan, hires_plan = generation_state.plan, generation_state.base_plan, generation_state.hires_plan
+    generation_state.base_plan = unet.get_plan_for_layout(base_plan, layout)
+    generation_state.hires_plan = generation_state.base_plan if hires_plan is base_plan else unet.get_plan_for_layout(hires_plan, layout)
+    if plan is base_plan:
+        generation_state.plan = generation_state.base_plan
+    elif plan is hires_plan:
+        generation_state.plan = generation_state.hires_plan
+
+    if unet.install_hooks(diffusion_model):
+        generation_state.hooked_model = diffusion_model
+
+
+def release_hooks(generation_state: global_state.GenerationState):
+    if generation_state.hooked_model is not None:
+        unet.uninstall_hooks(generation_state.hooked_model)
+        generation_state.hooked_model = None
+
+
+def on_cfg_denoiser(params):
+    generation_state = global_state.get_generation_state()
+    if generation_state.plan is None or generation_state.sigma_steps is None:
+        return
+
+    sigma_steps = generation_state.sigma_steps
+    generation_state.current_sampling_step = sigma_steps.get_step(float(params.sigma[0]))
+    generation_state.sampling_steps = sigma_steps.steps
+
+
+script_callbacks.on_cfg_denoiser(on_cfg_denoiser)
 
 
 def increment_sampling_step(*_args, **_kwargs):
-    global_state.current_sampling_step += 1
+    generation_state = global_state.get_generation_state()
+    if generation_state.sigma_steps is None:
+        # the sampler schedule is unknown (timestep based samplers), count denoiser calls instead
+        generation_state.current_sampling_step += 1
 
 
 try:
@@ -422,6 +625,18 @@ def on_after_component(component, **kwargs):
 script_callbacks.on_after_component(on_after_component)
 
 
+def on_model_loaded(sd_model):
+    unet.clear_caches()
+    sweep_cache.uninstall_all()
+    sweep_cache.cache.clear()
+    # a model loaded during a generation (refiner, hires checkpoint) replaces the hooked unet
+    generation_state = global_state.get_generation_state()
+    update_hooks(generation_state, getattr(getattr(sd_model, "model", None), "diffusion_model", None))
+
+
+script_callbacks.on_model_loaded(on_model_loaded)
+
+
 def on_ui_settings():
     section = ("freeu", "FreeU")
     shared.opts.add_option(
@@ -432,10 +647,84 @@ def on_ui_settings():
             section=section,
         )
     )
+    shared.opts.add_option(
+        "freeu_skip_filter_engine",
+        shared.OptionInfo(
+            default="rfft",
+            label="Skip connection filter engine",
+            component=gr.Radio,
+            component_args={"choices": ["auto", *unet.skip_filter_engines.keys()]},
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_skip_filter_fallback",
+        shared.OptionInfo(
+            default="matmul",
+            label="Skip connection filter on devices without complex number support (MPS, DirectML)",
+            component=gr.Radio,
+            component_args={"choices": ["matmul", "cpu"]},
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_skip_filter_precision",
+        shared.OptionInfo(
+            default="float32",
+            label="Skip connection filter precision (reduced keeps half precision inputs in half precision: float16 FFT on CUDA for power of two sizes, UNet dtype for matmul)",
+            component=gr.Radio,
+            component_args={"choices": unet.skip_filter_precisions},
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_sweep_cache",
+        shared.OptionInfo(
+            default=False,
+            label="Reuse UNet results of the steps before FreeU becomes active between generations with the same inputs (speeds up FreeU xyz sweeps, keeps a copy of the latents of each step)",
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_xyz_batch_sweep",
+        shared.OptionInfo(
+            default=False,
+            label="Run each FreeU xyz axis as one batch: all values of the axis share the seed and run in a single generation",
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_xyz_batch_max_size",
+        shared.OptionInfo(
+            default=8,
+            label="Maximum batch size of a batched FreeU xyz axis, longer axes run in several batches",
+            component=gr.Slider,
+            component_args={"minimum": 1, "maximum": 64, "step": 1},
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_profiling",
+        shared.OptionInfo(
+            default="off",
+            label="Profile FreeU stages (wall synchronizes the device, events uses cuda events). Summary goes to the console and infotext",
+            component=gr.Radio,
+            component_args={"choices": profiling.modes},
+            section=section,
+        )
+    )
+    shared.opts.add_option(
+        "freeu_compile_backbone_scale",
+        shared.OptionInfo(
+            default=False,
+            label="Compile the version 2 backbone scaling with torch.compile (falls back to eager if unsupported)",
+            section=section,
+        )
+    )
 
 
 script_callbacks.on_ui_settings(on_ui_settings)
 
 
-unet.patch()
+sampling_steps.patch()
 xyz_grid.patch()